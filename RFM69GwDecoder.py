@@ -9,22 +9,43 @@ This script parses the RFM69Gw published MQTT data and sends them to configured
 import re
 from typing import NamedTuple
 import paho.mqtt.client as mqtt
-from influxdb import InfluxDBClient
-import pprint
 import configparser
 import logging
 import sys
 import struct
+import math
 import time
 import signal
 import argparse
 import json
 import threading
-from werkzeug.serving import make_server
-import flask
+import queue
+import bisect
+import heapq
+import gzip
+import os
+import hashlib
+import zlib
+import functools
+import collections
+import itertools
+
+# imported by the backfill if it's installed (it decodes one payload at a time without it)
+numpy = None
 
 logLevel = ''
+logFormat = ''
+apiAddress = ''
 apiPort = 0
+healthMaxMessageAge = 0
+
+# receiving MQTT connection state and when the last message arrived (time.monotonic()), for /health and /ready
+mqttConnected = False
+lastMessageAt = None
+startedAt = time.monotonic()
+
+# debug output of the hot path (see DebugTrace), replaced when the config is (re)loaded
+debugTrace = None
 
 influxDbEnabled = False
 influxDbAddress = ''
@@ -32,6 +53,21 @@ influxDbPort = 0
 influxDbUser = ''
 influxDbPassword = ''
 influxDbDatabase = ''
+influxDbBatchSize = 0
+influxDbFlushInterval = 0.0
+influxDbQueueSize = 0
+influxDbDropPolicy = ''
+influxDbWriteMode = ''
+influxDbAggregateWindows = {}
+influxDbAggregateSuffix = ''
+influxDbGzipLevel = 0
+influxDbTimeout = 0.0
+influxDbSpoolDirectory = ''
+influxDbSpoolSegmentSize = 0
+influxDbSpoolMaxSize = 0
+influxDbRetryInterval = 0.0
+influxDbBackfillRate = 0
+influxDbLogRssi = False
 
 mqttAddress = ''
 mqttPort = 0
@@ -40,19 +76,101 @@ mqttPassword = ''
 mqttTopic = ''
 mqttRegex = ''
 mqttClientId = ''
+mqttPublishMaxInflight = 0
+mqttPublishQueueSize = 0
+mqttPublishRetries = 0
+
+# parses gateway topics (compiled from mqttRegex when the config is read)
+topicRouter = None
 
 rebroadcastEnabled = False
-rebroadcastSensors = []
 rebroadcastTopic = ''
+rebroadcastRules = []
 
 haIntegrationEnabled = False
 haBaseTopic = ''
 haStatusTopic = ''
-
-# this will hold [gwmac][sensorid][measurement] to show if we have provisoned this sensor
-provisionedSensors = {}
-
-# node type constants
+haStateFile = ''
+haSnapshotInterval = 0
+haPublishWindow = 0.0
+haDeadbands = {}
+haHeartbeat = 0
+haReplayChunkSize = 0
+haReplayChunkInterval = 0.0
+haAvailabilityMultiple = 0.0
+haAvailabilityMinTimeout = 0
+haAvailabilityMaxTimeout = 0
+
+pipelineDecodeWorkers = 0
+pipelineQueueSize = 0
+pipelineRuntime = ''
+pipelineProcesses = 0
+pipelineDedupWindow = 0.0
+
+# drops the copies of a packet heard by more than one gateway (only if dedup is enabled)
+duplicateFilter = None
+
+# our shard when we've been started as a worker by the supervisor (see supervise()), None otherwise
+shardIndex = None
+# the worker processes (supervisor only)
+shardWorkers = []
+
+captureEnabled = False
+captureDirectory = ''
+captureMaxSize = 0
+captureRotateInterval = 0
+captureKeep = 0
+captureQueueSize = 0
+
+# every measurement we've seen, with its last value and HA provisioning state (see SensorRegistry)
+sensorRegistry = None
+
+# coalesces HA state updates (only if HA integration is enabled), flushed by haFlushTimer
+haPublisher = None
+haFlushTimer = None
+
+# per node availability (only if HA integration and availability tracking are enabled), expired by nodeTimer
+nodeTracker = None
+nodeTimer = None
+
+# background replay of discovery configs and last values when HA comes online
+haReplay = None
+
+# (record, discovery payload, ok) of the discovery configs the publisher is done with, applied by the HA worker
+haProvisionResults = collections.deque()
+
+# HA metadata by (sensor type, measurement) and state topics by (gw, sensor), cleared when node types are reloaded
+haMeasurementCache = {}
+haStateTopicCache = {}
+# (measurement, gw, sensor, type) -> escaped line protocol series key
+influxSeriesKeys = {}
+
+# batched InfluxDB writer (only if InfluxDB is enabled)
+influxWriter = None
+
+# raw traffic recorder (only if capture is enabled)
+captureWriter = None
+
+# sends everything we publish, on a connection of its own
+mqttPublisher = None
+
+# set by the INT and TERM handlers, main() shuts down once it sees it
+stopRequested = False
+
+# pipeline workers: decode workers fed by the MQTT loop, plus one worker per MQTT based sink
+decodeStages = []
+rebroadcastStage = None
+
+# matches measurements to the rebroadcast rules (only if rebroadcast is enabled)
+rebroadcastRouter = None
+haStage = None
+aggregateStage = None
+
+# downsamples measurements before they go to InfluxDB (only if the write mode asks for it)
+aggregator = None
+aggregateTimer = None
+
+# built-in node type constants (more can be added in the config file)
 NODEFUNC_POWER_SINGLE = 1
 NODEFUNC_POWER_DOUBLE = 2
 NODEFUNC_POWER_QUAD = 3
@@ -60,24 +178,1870 @@ NODEFUNC_TEMP_RH = 4
 NODEFUNC_TEMP_PRESSURE = 5
 NODEFUNC_TRIGGER = 6
 
-# our API server
-app = flask.Flask(__name__)
+# every payload starts with the radio ID (16 bit) and the sensor type (8 bit)
+PAYLOAD_HEADER = struct.Struct('<HB')
+
+# config file we've been started with, re-read on USR1
+configFile = None
+
+# asyncio (only for the asyncio runtime), http.server (only for the threaded API server), subprocess (only for the
+# supervisor) and urllib.request (only for asking workers) are imported where they're used, to start up faster
+
+
+class ApiRequestHandler:
+    """ Answers GET (and HEAD) requests with server.respond(path), which returns (status, content type, body)
+
+    Mixed into http.server.BaseHTTPRequestHandler by ServerThread.
+    """
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def _respond(self, withBody):
+        status, contentType, body = self.server.respond(self.path.split('?', 1)[0])
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if withBody:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # no access log
+        pass
 
 
 class ServerThread(threading.Thread):
+    """ Our API server, built on http.server; respond is _api_response() or, for the supervisor, _supervisor_response() """
 
-    def __init__(self, app):
-        threading.Thread.__init__(self)
-        myLog.info('Starting API server on port ' + str(apiPort))
-        self.server = make_server('127.0.0.1', apiPort, app)
-        self.ctx = app.app_context()
-        self.ctx.push()
+    def __init__(self, respond):
+        import http.server
+
+        threading.Thread.__init__(self, name='ApiServer', daemon=True)
+        myLog.info('Starting API server on %s port %u', apiAddress, apiPort)
+        handler = type('ApiRequestHandler', (ApiRequestHandler, http.server.BaseHTTPRequestHandler), {})
+        self.server = http.server.ThreadingHTTPServer((apiAddress, apiPort), handler)
+        self.server.daemon_threads = True
+        self.server.respond = respond
 
     def run(self):
         self.server.serve_forever()
 
     def shutdown(self):
         self.server.shutdown()
+        self.server.server_close()
+
+
+class JsonLogFormatter(logging.Formatter):
+    """ Formats log records as one JSON object per line, with the fields of DebugTrace events as keys """
+
+    def format(self, record):
+        data = {'ts': record.created, 'level': record.levelname, 'message': record.getMessage()}
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class DebugTrace:
+    """ Debug output for the hot path, which costs next to nothing when it's off
+
+    Callers check enabled() before building anything to log. It's true when the process runs at DEBUG, or, when
+    gateways or sensors are set, only for those gateways / sensors (whatever the log level), so a single node can be
+    debugged in production. On top of that only one in sample events is logged, and at most rate events per second
+    per (gw, sensor) (0 is unlimited).
+    """
+
+    def __init__(self, logger, gateways, sensors, sample, rate):
+        self.logger = logger
+        self.gateways = set(gateways) if gateways else None
+        self.sensors = set(sensors) if sensors else None
+        self.filtered = self.gateways is not None or self.sensors is not None
+        self.sample = max(1, sample)
+        self.rate = rate
+        # next() on a count is atomic, so the decode workers can share it
+        self.counter = itertools.count()
+        # (gw, sensor) -> [second, events logged in that second]
+        self.budgets = {}
+        # with filters, the events of the selected nodes get through whatever the log level is
+        self.logger.setLevel(logging.DEBUG if self.filtered else logging.NOTSET)
+
+    def enabled(self, gw=None, sensor=None):
+        if self.filtered:
+            if self.gateways is not None and gw not in self.gateways:
+                return False
+            if self.sensors is not None and str(sensor) not in self.sensors:
+                return False
+        elif not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+
+        if self.sample > 1 and next(self.counter) % self.sample:
+            return False
+
+        if self.rate:
+            second = int(time.monotonic())
+            budget = self.budgets.get((gw, sensor))
+            if budget is None or budget[0] != second:
+                budget = self.budgets[(gw, sensor)] = [second, 0]
+            if budget[1] >= self.rate:
+                return False
+            budget[1] += 1
+
+        return True
+
+    def log(self, event, gw=None, sensor=None, **fields):
+        fields = dict(event=event, gw=gw, sensor=sensor, **fields)
+        text = ' '.join('%s=%s' % (k, v) for k, v in fields.items() if k != 'event')
+        self.logger.debug('%s %s', event, text, extra={'fields': fields})
+
+
+class InfluxWriteError(Exception):
+    """ InfluxDB refused a write, status is the HTTP status code """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, 'HTTP %u: %s' % (status, message))
+        self.status = status
+
+
+class InfluxLineClient:
+    """ Minimal InfluxDB 1.x HTTP client, writes line protocol batches over a pooled session
+
+    Batches are gzip compressed unless gzipLevel is 0. The session keeps the connection open between writes.
+    """
+
+    def __init__(self, address, port, user, password, database, gzipLevel, timeout):
+        # only loaded when InfluxDB is enabled
+        import requests
+
+        self.database = database
+        self.gzipLevel = gzipLevel
+        self.timeout = timeout
+        self.baseUrl = 'http://%s:%u' % (address, port)
+        self.writeParams = { 'db': database, 'precision': 'ns' }
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        self.headers = { 'Content-Type': 'text/plain; charset=utf-8' }
+        if gzipLevel:
+            self.headers['Content-Encoding'] = 'gzip'
+
+    def create_database(self):
+        # only create the database if it's not there, CREATE DATABASE needs admin rights
+        r = self.session.get(self.baseUrl + '/query', params={ 'q': 'SHOW DATABASES' }, timeout=self.timeout)
+        if r.status_code != 200:
+            raise InfluxWriteError(r.status_code, r.text)
+        series = r.json()['results'][0].get('series', [])
+        if any(values[0] == self.database for values in (series[0].get('values', []) if series else [])):
+            return
+
+        myLog.warning("Database doesn't exists - will create it")
+        r = self.session.post(self.baseUrl + '/query', params={ 'q': 'CREATE DATABASE "%s"' % self.database }, timeout=self.timeout)
+        if 400 <= r.status_code < 500:
+            # not allowed to, the writes will tell whether the database is there after all
+            myLog.error('Unable to create database %s: %s', self.database, r.text)
+        elif r.status_code != 200:
+            raise InfluxWriteError(r.status_code, r.text)
+
+    def write(self, lines):
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        if self.gzipLevel:
+            body = gzip.compress(body, self.gzipLevel)
+        r = self.session.post(self.baseUrl + '/write', params=self.writeParams, data=body, headers=self.headers, timeout=self.timeout)
+        if r.status_code != 204:
+            raise InfluxWriteError(r.status_code, r.text)
+
+
+class InfluxSpool:
+    """ Append-only on-disk spool of line protocol points that couldn't be written to InfluxDB
+
+    Points are appended to numbered segment files of up to segmentSize bytes. When the spool grows past
+    maxSize, the oldest segment is dropped. Segments are read back oldest first and deleted once all their
+    points were written; a segment that was half sent when we stopped is sent again from the start, which
+    InfluxDB simply overwrites. Only used from the writer thread.
+    """
+
+    def __init__(self, directory, segmentSize, maxSize):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxSize = maxSize
+        os.makedirs(directory, exist_ok=True)
+        # segment numbers, oldest first, and their sizes
+        self.segments = sorted(int(name[:-3]) for name in os.listdir(directory) if name.endswith('.lp') and name[:-3].isdigit())
+        self.sizes = {seq: os.path.getsize(self._path(seq)) for seq in self.segments}
+        self.size = sum(self.sizes.values())
+        self.writeSeq = None
+        self.writeFile = None
+        self.readSeq = None
+        self.readFile = None
+        self.readDone = False
+        # points handed out by read() and not committed yet
+        self.unsent = None
+        self.spooled = 0
+        self.dropped = 0
+        if self.segments:
+            myLog.info('Found %u bytes of spooled InfluxDB points in %s', self.size, directory)
+
+    def _path(self, seq):
+        return os.path.join(self.directory, '%010u.lp' % seq)
+
+    def pending(self):
+        return bool(self.segments)
+
+    def append(self, lines):
+        if self.writeFile is None or self.sizes[self.writeSeq] >= self.segmentSize:
+            self._close_write()
+            self.writeSeq = self.segments[-1] + 1 if self.segments else 0
+            self.writeFile = open(self._path(self.writeSeq), 'ab')
+            self.segments.append(self.writeSeq)
+            self.sizes[self.writeSeq] = 0
+
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        self.writeFile.write(data)
+        self.writeFile.flush()
+        self.sizes[self.writeSeq] += len(data)
+        self.size += len(data)
+        self.spooled += len(lines)
+
+        # keep within the size cap by dropping the oldest data
+        while self.size > self.maxSize and len(self.segments) > 1:
+            seq = self.segments[0]
+            if seq == self.readSeq:
+                self._close_read()
+            myLog.warning('InfluxDB spool is full, dropping segment %u', seq)
+            self.dropped += 1
+            self._remove(seq)
+
+    def read(self, count):
+        # up to count of the oldest points; they stay in the spool until commit()
+        if self.unsent is not None:
+            return self.unsent
+        if self.readFile is None:
+            if not self.segments:
+                return []
+            self.readSeq = self.segments[0]
+            if self.readSeq == self.writeSeq:
+                # the segment becomes read only, the next append starts a new one
+                self._close_write()
+            self.readFile = open(self._path(self.readSeq), 'rb')
+            self.readDone = False
+
+        lines = []
+        while len(lines) < count:
+            line = self.readFile.readline()
+            if not line:
+                self.readDone = True
+                break
+            line = line.decode('utf-8', errors='replace').rstrip('\n')
+            if line:
+                lines.append(line)
+        self.unsent = lines
+        return lines
+
+    def commit(self):
+        # the points from the last read() are written (or given up on)
+        self.unsent = None
+        if self.readDone:
+            seq = self.readSeq
+            self._close_read()
+            self._remove(seq)
+
+    def close(self):
+        self._close_write()
+        self._close_read()
+
+    def _close_write(self):
+        if self.writeFile is not None:
+            self.writeFile.close()
+            self.writeFile = None
+            self.writeSeq = None
+
+    def _close_read(self):
+        if self.readFile is not None:
+            self.readFile.close()
+            self.readFile = None
+        self.readSeq = None
+        self.readDone = False
+        self.unsent = None
+
+    def _remove(self, seq):
+        self.segments.remove(seq)
+        self.size -= self.sizes.pop(seq)
+        try:
+            os.remove(self._path(seq))
+        except OSError as e:
+            myLog.error('Unable to remove spool segment %u: %s', seq, e)
+
+
+class InfluxWriterThread(threading.Thread):
+    """ Takes InfluxDB line protocol lines off a bounded queue and writes them in batches
+
+    A batch is flushed when it reaches batchSize lines or when flushInterval seconds have passed since
+    its first line was queued, whichever comes first. When the queue is full, dropPolicy decides what happens:
+    'drop_oldest' discards the oldest queued line, 'drop_newest' discards the new line and 'block' waits
+    for room. Blocking holds up the decode workers (or the aggregator) instead, so it's their queues that
+    fill up and drop incoming messages.
+
+    With a spool, batches that fail because InfluxDB is unavailable are spooled to disk instead of lost, and
+    for retryInterval seconds after a failure new batches go straight to the spool. Once writes succeed again,
+    the spool is sent back oldest first, in batchSize chunks and at no more than backfillRate points/s
+    (0 is unlimited), in between the live batches.
+    """
+
+    def __init__(self, client, batchSize, flushInterval, queueSize, dropPolicy, spool=None, retryInterval=5.0, backfillRate=0):
+        threading.Thread.__init__(self, name='InfluxWriter')
+        self.client = client
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.dropPolicy = dropPolicy
+        self.queue = queue.Queue(queueSize)
+        self.statsLock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        self.batches = 0
+        self.lastBatchSize = 0
+        self.maxBatchSize = 0
+        self.lastFlushLatency = 0.0
+        self.maxFlushLatency = 0.0
+        # set to a LatencyHistogram to count the flush latencies (used by the replay benchmark)
+        self.latencies = None
+        self.spool = spool
+        self.retryInterval = retryInterval
+        self.backfillRate = backfillRate
+        self.retryAt = 0.0
+        self.backfillAt = 0.0
+        self.backfilled = 0
+        self.databaseReady = False
+        # whether the last write worked, None until there's been one
+        self.lastWriteOk = None
+
+    def put(self, point):
+        # queue a single line protocol point; never blocks unless the drop policy says so
+        if self.dropPolicy == 'block':
+            self.queue.put(point)
+        else:
+            try:
+                self.queue.put_nowait(point)
+            except queue.Full:
+                with self.statsLock:
+                    self.dropped += 1
+                if self.dropPolicy == 'drop_newest':
+                    return
+                # make room by discarding the oldest point
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(point)
+                except queue.Full:
+                    return
+
+        with self.statsLock:
+            self.queued += 1
+
+    def run(self):
+        batch = []
+        deadline = None
+        running = True
+
+        while running:
+            wakeup = deadline
+            if self.spool is not None and self.spool.pending():
+                backfillAt = max(self.backfillAt, self.retryAt)
+                wakeup = backfillAt if wakeup is None else min(wakeup, backfillAt)
+            if wakeup is None:
+                timeout = None
+            else:
+                timeout = max(0.0, wakeup - time.monotonic())
+
+            try:
+                point = self.queue.get(timeout=timeout)
+                # grab whatever else is already waiting, up to the batch size
+                while True:
+                    # None is our stop marker
+                    if point is None:
+                        running = False
+                        break
+                    batch.append(point)
+                    if len(batch) >= self.batchSize:
+                        break
+                    point = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            if batch:
+                if deadline is None:
+                    deadline = time.monotonic() + self.flushInterval
+                if not running or len(batch) >= self.batchSize or time.monotonic() >= deadline:
+                    self._flush(batch)
+                    batch = []
+                    deadline = None
+
+            if running and self.spool is not None and self.spool.pending():
+                now = time.monotonic()
+                if now >= self.backfillAt and now >= self.retryAt:
+                    self._backfill()
+
+        if self.spool is not None:
+            self.spool.close()
+
+    def _write(self, lines):
+        # the database is created on the first write, so we can start while InfluxDB is down
+        if not self.databaseReady:
+            self.client.create_database()
+            self.databaseReady = True
+        self.client.write(lines)
+
+    def _spool(self, batch):
+        try:
+            self.spool.append(batch)
+        except OSError as e:
+            myLog.error('Unable to spool %u points: %s', len(batch), e)
+            return
+        metricInfluxPointsSpooled.inc(amount=len(batch))
+
+    def _flush(self, batch):
+        if self.spool is not None and time.monotonic() < self.retryAt:
+            # InfluxDB failed recently, don't wait for another timeout
+            self._spool(batch)
+            return
+
+        start = time.monotonic()
+        transient = False
+        try:
+            self._write(batch)
+            ok = True
+        except InfluxWriteError as e:
+            myLog.error('InfluxDB refused %u points: %s', len(batch), e)
+            ok = False
+            # a 4xx means there's something wrong with the points, sending them again won't help
+            transient = not 400 <= e.status < 500
+        except:
+            myLog.error('Exception while writing %u points to database', len(batch))
+            ok = False
+            transient = True
+        latency = time.monotonic() - start
+
+        if transient and self.spool is not None:
+            self.retryAt = time.monotonic() + self.retryInterval
+            self._spool(batch)
+
+        metricInfluxWriteSeconds.observe(latency)
+        self.lastWriteOk = ok
+        if ok:
+            metricInfluxPointsWritten.inc(amount=len(batch))
+        else:
+            metricInfluxWriteErrors.inc()
+
+        with self.statsLock:
+            self.batches += 1
+            if ok:
+                self.written += len(batch)
+            else:
+                self.errors += 1
+            self.lastBatchSize = len(batch)
+            self.maxBatchSize = max(self.maxBatchSize, len(batch))
+            self.lastFlushLatency = latency
+            self.maxFlushLatency = max(self.maxFlushLatency, latency)
+            if self.latencies is not None:
+                self.latencies.observe(latency)
+
+    def _backfill(self):
+        lines = self.spool.read(self.batchSize)
+        if not lines:
+            self.spool.commit()
+            return
+
+        try:
+            self._write(lines)
+        except InfluxWriteError as e:
+            if 400 <= e.status < 500:
+                myLog.error('InfluxDB refused %u spooled points, discarding them: %s', len(lines), e)
+                self.spool.commit()
+            else:
+                self.retryAt = time.monotonic() + self.retryInterval
+            return
+        except:
+            myLog.warning('InfluxDB still unavailable, %u bytes spooled', self.spool.size)
+            self.retryAt = time.monotonic() + self.retryInterval
+            return
+
+        self.spool.commit()
+        self.lastWriteOk = True
+        metricInfluxPointsBackfilled.inc(amount=len(lines))
+        with self.statsLock:
+            self.backfilled += len(lines)
+        if self.backfillRate:
+            self.backfillAt = time.monotonic() + len(lines) / self.backfillRate
+        if not self.spool.pending():
+            myLog.info('InfluxDB backfill complete')
+
+    def stats(self):
+        with self.statsLock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'queued': self.queued,
+                'dropped': self.dropped,
+                'written': self.written,
+                'errors': self.errors,
+                'batches': self.batches,
+                'last_batch_size': self.lastBatchSize,
+                'max_batch_size': self.maxBatchSize,
+                'last_flush_latency': self.lastFlushLatency,
+                'max_flush_latency': self.maxFlushLatency,
+                'spooled': self.spool.spooled if self.spool is not None else 0,
+                'backfilled': self.backfilled,
+                'spool_bytes': self.spool.size if self.spool is not None else 0,
+                'spool_segments_dropped': self.spool.dropped if self.spool is not None else 0,
+            }
+
+    def shutdown(self):
+        # queue the stop marker behind everything else, so pending points get flushed
+        self.queue.put(None)
+        self.join()
+
+
+class NodeField(NamedTuple):
+    measurement: str            # name of the measurement, e.g. power1, temp, etc
+    offset: int                 # byte offset in the payload
+    width: int                  # width in bytes (1, 2 or 4), little endian
+    signed: bool                # signed or unsigned integer
+    divisor: float = None       # the raw value is divided by this; None keeps the raw integer
+    device_class: str = None    # HA device class
+    unit: str = None            # HA unit of measurement
+    component: str = 'sensor'   # HA component, sensor or binary_sensor
+
+
+class NodeDecoder:
+    """ Decodes the payload of one node type with a precompiled struct
+
+    Fields are packed into a single struct (with padding for any gaps) so a payload is decoded with one
+    unpack call. Fields overlapping an earlier one can't be part of that struct, they get their own.
+    """
+
+    # struct format characters for (width, signed)
+    FORMATS = {(1, False): 'B', (1, True): 'b', (2, False): 'H', (2, True): 'h', (4, False): 'I', (4, True): 'i'}
+
+    def __init__(self, sensType, name, layout):
+        self.sensType = sensType
+        self.name = name
+        self._validate(layout)
+
+        # field metadata by measurement name (for HA)
+        self.info = {f.measurement: f for f in layout}
+
+        fmt = '<'
+        pos = 0
+        extras = []
+        # index of each field in the unpacked tuple, in layout order
+        index = {}
+        count = 0
+
+        for f in sorted(layout, key=lambda f: f.offset):
+            c = self.FORMATS[(f.width, f.signed)]
+            if f.offset >= pos:
+                if f.offset > pos:
+                    fmt += str(f.offset - pos) + 'x'
+                fmt += c
+                pos = f.offset + f.width
+                index[f.measurement] = count
+                count += 1
+            else:
+                extras.append((f.measurement, f.offset, struct.Struct('<' + c)))
+
+        for name, offset, s in extras:
+            index[name] = count
+            count += 1
+
+        self.struct = struct.Struct(fmt)
+        self.extras = [(s, offset) for name, offset, s in extras]
+        self.fields = [(f.measurement, index[f.measurement], f.divisor) for f in layout]
+        # shortest payload with every field in it
+        self.size = max(f.offset + f.width for f in layout)
+        # NumPy structured dtype for decode_batch(), built when it's first needed
+        self.dtype = None
+
+    def _validate(self, layout):
+        # only raises ValueError, whatever the config has in it
+        where = 'node type %s (%s)' % (self.sensType, self.name)
+        if not layout:
+            raise ValueError(where + ' has no fields')
+
+        seen = set()
+        for f in layout:
+            if not isinstance(f.measurement, str):
+                raise ValueError('%s has an invalid measurement name %r' % (where, f.measurement))
+            if f.measurement in seen:
+                raise ValueError('%s has more than one %s field' % (where, f.measurement))
+            seen.add(f.measurement)
+            # the config is JSON, so "2", "false" or 7 would get this far
+            for attr, types in (('offset', int), ('width', int), ('signed', bool), ('divisor', (int, float, type(None))),
+                                ('device_class', (str, type(None))), ('unit', (str, type(None)))):
+                value = getattr(f, attr)
+                if not isinstance(value, types) or (attr != 'signed' and isinstance(value, bool)):
+                    raise ValueError('%s: %s has an invalid %s %r' % (where, f.measurement, attr, value))
+            if (f.width, f.signed) not in self.FORMATS:
+                raise ValueError('%s: %s has an invalid width %r' % (where, f.measurement, f.width))
+            if f.offset < PAYLOAD_HEADER.size:
+                raise ValueError('%s: %s overlaps the payload header' % (where, f.measurement))
+            if f.divisor is not None and f.divisor == 0:
+                raise ValueError('%s: %s has a zero divisor' % (where, f.measurement))
+            if f.component not in ('sensor', 'binary_sensor'):
+                raise ValueError('%s: %s has an unknown component %r' % (where, f.measurement, f.component))
+
+    def decode(self, raw):
+        # returns a list of (measurement, value)
+        values = self.struct.unpack_from(raw)
+        for s, offset in self.extras:
+            values += s.unpack_from(raw, offset)
+
+        return [(name, values[i] if divisor is None else values[i] / divisor) for name, i, divisor in self.fields]
+
+    def decode_batch(self, rows):
+        # decodes many payloads of exactly self.size bytes in one go; returns the radio IDs and a list of values
+        # per measurement, in row order. With NumPy, every column is decoded in a single vectorised pass (overlapping
+        # fields are fine in a structured dtype)
+        if numpy is None:
+            radioIds = [PAYLOAD_HEADER.unpack_from(raw)[0] for raw in rows]
+            values = {name: [] for name, i, divisor in self.fields}
+            for raw in rows:
+                for name, value in self.decode(raw):
+                    values[name].append(value)
+            return radioIds, values
+
+        if self.dtype is None:
+            fields = list(self.info.values())
+            self.dtype = numpy.dtype({
+                'names': ['_radio_id'] + [f.measurement for f in fields],
+                'formats': ['<u2'] + ['<' + ('i' if f.signed else 'u') + str(f.width) for f in fields],
+                'offsets': [0] + [f.offset for f in fields],
+                'itemsize': self.size,
+            })
+
+        data = numpy.frombuffer(b''.join(rows), self.dtype)
+        values = {}
+        for name, i, divisor in self.fields:
+            column = data[name]
+            values[name] = (column if divisor is None else column / divisor).tolist()
+        return data['_radio_id'].tolist(), values
+
+
+def _compile_node_decoders(layouts):
+    # build the sensor type -> decoder dispatch table
+    return {sensType: NodeDecoder(sensType, name, layout) for sensType, (name, layout) in layouts.items()}
+
+
+def _read_node_layouts(config):
+    # start with the built-in node types, then add or override them from the [nodetype_<id>] sections
+    layouts = dict(NODE_LAYOUTS)
+
+    for section in config.sections():
+        if not section.startswith('nodetype_'):
+            continue
+
+        try:
+            sensType = int(section[len('nodetype_'):])
+        except ValueError:
+            raise ValueError('Invalid node type section name: ' + section)
+
+        fields = []
+        try:
+            for f in json.loads(config.get(section, 'fields', raw=True)):
+                # the types are checked by NodeDecoder
+                fields.append(NodeField(f['measurement'], f['offset'], f['width'], f.get('signed', False),
+                                        f.get('divisor'), f.get('device_class'), f.get('unit'), f.get('component', 'sensor')))
+        except (configparser.Error, ValueError, KeyError, TypeError) as e:
+            raise ValueError('Invalid fields in ' + section + ': ' + str(e))
+
+        layouts[sensType] = (config.get(section, 'name', fallback=section), fields)
+
+    return layouts
+
+
+# payload layout of the built-in node types, one entry per measurement
+# these can be overridden (and new ones added) with [nodetype_<id>] sections in the config file
+NODE_LAYOUTS = {
+    NODEFUNC_POWER_SINGLE: ('power_single', [
+        NodeField('power1', 3, 2, True, None, 'power', 'W'),
+        NodeField('vrms', 5, 2, False, 10, 'voltage', 'V'),
+    ]),
+    NODEFUNC_POWER_DOUBLE: ('power_double', [
+        NodeField('power1', 3, 2, True, None, 'power', 'W'),
+        NodeField('power2', 5, 2, True, None, 'power', 'W'),
+        NodeField('vrms', 7, 2, False, 10, 'voltage', 'V'),
+    ]),
+    NODEFUNC_POWER_QUAD: ('power_quad', [
+        NodeField('power1', 3, 2, True, None, 'power', 'W'),
+        NodeField('power2', 5, 2, True, None, 'power', 'W'),
+        NodeField('power3', 7, 2, True, None, 'power', 'W'),
+        NodeField('power4', 9, 2, True, None, 'power', 'W'),
+        NodeField('vrms', 11, 2, False, 10, 'voltage', 'V'),
+    ]),
+    NODEFUNC_TEMP_RH: ('temp_rh', [
+        NodeField('temp', 3, 2, True, 100, 'temperature', '°C'),
+        NodeField('rh', 5, 2, False, 100, 'humidity', '%'),
+        NodeField('vbatt', 7, 2, False, None, 'voltage', 'mV'),
+    ]),
+    NODEFUNC_TEMP_PRESSURE: ('temp_pressure', [
+        NodeField('temp', 3, 2, True, 100, 'temperature', '°C'),
+        NodeField('pressure', 5, 4, False, 100, 'pressure', 'mbar'),
+        NodeField('vbatt', 7, 2, False, None, 'voltage', 'mV'),
+    ]),
+    NODEFUNC_TRIGGER: ('trigger', [
+        NodeField('trigger', 3, 1, False, None, component='binary_sensor'),
+        NodeField('vbatt', 4, 2, False, None, 'voltage', 'mV'),
+    ]),
+}
+
+# compiled at startup (and on USR1), looked up by sensor type for every message
+nodeDecoders = _compile_node_decoders(NODE_LAYOUTS)
+
+
+class TopicRoute(NamedTuple):
+    gw: str         # gateway mac address (without colons), or the gateway name if it doesn't contain one
+    radioId: str    # radio ID level of the topic
+    kind: str       # what the message is: payload, rssi, etc
+
+
+class TopicRouter:
+    """ Splits gateway topics into routes, with the patterns compiled once and the result cached per topic
+
+    The topic set is small and fixed, so after the first message of a topic routing is a cache hit. The cache
+    is a bounded LRU (functools.lru_cache, which is safe to share between the decode workers). route() returns
+    None for topics that aren't from a gateway.
+    """
+
+    # the gateway name looks like <prefix>-<mac address>-<suffix>
+    MAC_PATTERN = re.compile('-(..:..:..:..:..:..)-')
+
+    def __init__(self, regex, cacheSize=1024):
+        self.pattern = re.compile(regex)
+        self.route = functools.lru_cache(maxsize=cacheSize)(self._parse)
+
+    def _parse(self, topic):
+        match = self.pattern.match(topic)
+        if match is None:
+            return None
+
+        gw = match.group(1)
+        # extract the MAC address (and strip out the colons)
+        macMatch = self.MAC_PATTERN.search(gw)
+        if macMatch:
+            gw = macMatch.group(1).replace(':', '')
+
+        kind = match.group(3)
+        # anything with payload in its name has always been decoded as a payload
+        if 'payload' in kind:
+            kind = 'payload'
+        return TopicRoute(gw, match.group(2), kind)
+
+    def stats(self):
+        info = self.route.cache_info()
+        return {'topics': info.currsize, 'hits': info.hits, 'misses': info.misses}
+
+
+class RebroadcastRule(NamedTuple):
+    gateways: frozenset     # gateways the rule applies to, None for all of them
+    nodes: frozenset        # node IDs (ranges expanded), None for all of them
+    types: frozenset        # sensor types, None for all of them
+    measurements: frozenset # measurements to publish, None for all of them
+    topic: str              # topic template, {gw}, {node}, {type} and {name} (node type name) are filled in
+    qos: int
+    retain: bool
+
+
+class RebroadcastRouter:
+    """ Finds where the measurements of a node are rebroadcast to
+
+    Rules are indexed by node ID, with the ones for any node kept apart. The targets of a (gw, node, type) are
+    resolved once, with their topics filled in, so after the first message of a node a lookup is one dict hit.
+    Only used from the rebroadcast worker.
+    """
+
+    def __init__(self, rules):
+        # node ID -> [(rule number, rule)], the number keeps the rules in config order
+        self.byNode = {}
+        self.anyNode = []
+        for i, rule in enumerate(rules):
+            if rule.nodes is None:
+                self.anyNode.append((i, rule))
+            else:
+                for node in rule.nodes:
+                    self.byNode.setdefault(node, []).append((i, rule))
+        # (gw, node, type) -> [(topic, measurements, qos, retain)]
+        self.targets = {}
+
+    def route(self, gw, node, sensType):
+        key = (gw, node, sensType)
+        targets = self.targets.get(key)
+        if targets is None:
+            decoder = nodeDecoders.get(sensType)
+            name = decoder.name if decoder is not None else str(sensType)
+            targets = self.targets[key] = [
+                (rule.topic.format(gw=gw, node=node, type=sensType, name=name), rule.measurements, rule.qos, rule.retain)
+                for i, rule in sorted(self.byNode.get(node, []) + self.anyNode, key=lambda r: r[0])
+                if (rule.gateways is None or gw in rule.gateways) and (rule.types is None or sensType in rule.types)]
+        return targets
+
+    def clear(self):
+        # node type names may have changed, resolve the targets again
+        self.targets.clear()
+
+
+def _node_ids(spec):
+    # node IDs are numbers, or 'first-last' ranges
+    nodes = set()
+    for n in spec:
+        if isinstance(n, str) and '-' in n:
+            first, last = n.split('-', 1)
+            nodes.update(range(int(first), int(last) + 1))
+        else:
+            nodes.add(int(n))
+    return frozenset(nodes)
+
+
+def _read_rebroadcast_rules(config):
+    text = config.get('rebroadcast', 'rules', fallback='')
+    if not text.strip():
+        # the old style setting: every measurement of the listed nodes to <topic>/<node>
+        nodes = json.loads(config.get('rebroadcast', 'sensor_list', fallback='[]'))
+        return [RebroadcastRule(None, _node_ids(nodes), None, None, rebroadcastTopic.replace('{', '{{').replace('}', '}}') + '/{node}', 0, False)]
+
+    rules = []
+    try:
+        for i, r in enumerate(json.loads(text)):
+            gateways = r.get('gateways')
+            nodes = r.get('nodes')
+            types = r.get('types')
+            measurements = r.get('measurements')
+            rule = RebroadcastRule(frozenset(str(gw).replace(':', '') for gw in gateways) if gateways is not None else None,
+                                   _node_ids(nodes) if nodes is not None else None,
+                                   frozenset(int(t) for t in types) if types is not None else None,
+                                   frozenset(measurements) if measurements is not None else None,
+                                   r.get('topic', rebroadcastTopic.replace('{', '{{').replace('}', '}}') + '/{node}'),
+                                   int(r.get('qos', 0)), bool(r.get('retain', False)))
+            if rule.qos not in (0, 1, 2):
+                raise ValueError('rule ' + str(i) + ' has an invalid QoS ' + str(rule.qos))
+            # catch unknown placeholders now, rather than on the first message
+            rule.topic.format(gw='', node=0, type=0, name='')
+            rules.append(rule)
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+        raise ValueError('Invalid rebroadcast rules: ' + repr(e))
+    return rules
+
+
+class DuplicateFilter:
+    """ Remembers the packets of the last window seconds, to spot the copies other gateways heard as well
+
+    Keys go into time buckets of window / BUCKETS seconds and whole buckets expire at once, so inserting and
+    expiring are O(1) per key. A copy counts as a duplicate for window seconds (up to one bucket more) after the
+    first one. Only used from the MQTT network loop.
+    """
+
+    BUCKETS = 10
+
+    def __init__(self, window):
+        self.window = window
+        self.width = window / self.BUCKETS
+        self.keys = set()
+        # (bucket number, keys first seen in it), oldest first
+        self.buckets = collections.deque()
+        self.passed = 0
+        self.suppressed = 0
+
+    def first(self, key, now):
+        # True for the first copy of key, False for the ones following it within the window
+        bucket = int(now // self.width)
+        while self.buckets and self.buckets[0][0] <= bucket - self.BUCKETS:
+            self.keys.difference_update(self.buckets.popleft()[1])
+
+        if key in self.keys:
+            self.suppressed += 1
+            return False
+
+        self.keys.add(key)
+        if not self.buckets or self.buckets[-1][0] != bucket:
+            self.buckets.append((bucket, []))
+        self.buckets[-1][1].append(key)
+        self.passed += 1
+        return True
+
+    def stats(self):
+        return {'passed': self.passed, 'suppressed': self.suppressed, 'remembered': len(self.keys)}
+
+
+class CaptureWriterThread(threading.Thread):
+    """ Records every received MQTT message to rotating, gzip compressed files
+
+    Lines have the same format read_capture_file() expects: receive timestamp, topic and payload, tab separated.
+    A new file is started when the current one reaches maxSize bytes (compressed) or is rotateInterval seconds
+    old; only the newest keep files are kept. Messages are written in chunks from this thread, the MQTT loop
+    only queues them (and drops them when the queue is full).
+    """
+
+    # lines written in one go
+    CHUNK_SIZE = 1000
+
+    def __init__(self, directory, maxSize, rotateInterval, keep, queueSize):
+        threading.Thread.__init__(self, name='CaptureWriter')
+        self.directory = directory
+        self.maxSize = maxSize
+        self.rotateInterval = rotateInterval
+        self.keep = keep
+        self.queue = queue.Queue(queueSize)
+        self.file = None
+        self.openedAt = 0.0
+        self.dropped = 0
+        self.written = 0
+
+    def put(self, topic, payload, recvTs):
+        try:
+            self.queue.put_nowait((recvTs, topic, payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        running = True
+        while running:
+            lines = []
+            try:
+                item = self.queue.get(timeout=1.0)
+                while True:
+                    # None is our stop marker
+                    if item is None:
+                        running = False
+                        break
+                    recvTs, topic, payload = item
+                    # tabs and newlines would break the line format
+                    payload = payload.decode('utf-8', 'replace').replace('\t', ' ').replace('\n', ' ')
+                    lines.append('%.3f\t%s\t%s\n' % (recvTs, topic, payload))
+                    if len(lines) >= self.CHUNK_SIZE:
+                        break
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            try:
+                if lines:
+                    self._write(lines)
+                if self.file is not None and (not running or self._rotation_due()):
+                    self._close()
+            except OSError as e:
+                myLog.error('Unable to write capture file: %s', e)
+                self.file = None
+
+    def _rotation_due(self):
+        return self.file.fileobj.tell() >= self.maxSize or time.time() - self.openedAt >= self.rotateInterval
+
+    def _write(self, lines):
+        if self.file is None:
+            self._open()
+        self.file.write(''.join(lines).encode('utf-8'))
+        # push the compressed data out, so a crash loses at most the last chunk
+        self.file.flush()
+        self.written += len(lines)
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.openedAt = time.time()
+        fileName = os.path.join(self.directory, time.strftime('capture-%Y%m%d-%H%M%S.tsv.gz', time.localtime(self.openedAt)))
+        myLog.info('Capturing MQTT traffic to %s', fileName)
+        self.file = gzip.open(fileName, 'ab')
+
+        # get rid of the oldest captures
+        captures = sorted(f for f in os.listdir(self.directory) if f.startswith('capture-') and f.endswith('.tsv.gz'))
+        for f in captures[:-self.keep]:
+            os.remove(os.path.join(self.directory, f))
+
+    def _close(self):
+        self.file.close()
+        self.file = None
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+        }
+
+    def shutdown(self):
+        # queue the stop marker behind everything else, so pending messages get written
+        self.queue.put(None)
+        self.join()
+
+
+class MqttPublisher(threading.Thread):
+    """ Publishes our outgoing MQTT messages on a connection of its own, so bursts don't hold up receiving
+
+    Messages wait in priority lanes: HA status first, then discovery configs and availability, then everything
+    else (state updates, rebroadcasts). A lane holds up to queueSize messages, new ones are dropped when it's full.
+    At most maxInflight messages are on their way at a time, that is published but not yet sent (QoS 0) or
+    acknowledged (QoS 1 and 2). A publish the client refuses is retried, up to retries times, once it's connected.
+    put() returns whether the message was queued; its done(ok) is called from this thread once the client took the
+    message, or we gave up on it.
+    """
+
+    # lane of each kind of message, anything else goes to the last one
+    LANES = {'ha_status': 0, 'ha_discovery': 1, 'ha_availability': 1}
+    LANE_COUNT = 3
+
+    def __init__(self, client, maxInflight, queueSize, retries):
+        threading.Thread.__init__(self, name='MqttPublisher')
+        self.client = client
+        self.maxInflight = maxInflight
+        self.queueSize = queueSize
+        self.retries = retries
+        self.lanes = [collections.deque() for i in range(self.LANE_COUNT)]
+        self.cond = threading.Condition()
+        self.inflight = set()
+        # mids paho reported as published before publish() returned them to us
+        self.early = set()
+        self.connected = False
+        self.running = True
+        self.stopDeadline = None
+        self.published = 0
+        self.dropped = 0
+        self.retried = 0
+        self.failed = 0
+        client.on_publish = self._on_publish
+        client.on_disconnect = self._on_disconnect
+
+    def put(self, kind, topic, payload, qos, retain, done=None):
+        lane = self.lanes[self.LANES.get(kind, self.LANE_COUNT - 1)]
+        with self.cond:
+            if len(lane) >= self.queueSize:
+                self.dropped += 1
+                return False
+            # the last but one item counts the attempts
+            lane.append([topic, payload, qos, retain, 0, done])
+            self.cond.notify()
+        return True
+
+    def set_connected(self):
+        with self.cond:
+            self.connected = True
+            self.cond.notify()
+
+    def _on_disconnect(self, client, userdata, rc):
+        myLog.warning('MQTT publisher disconnected with result code %s', str(rc))
+        with self.cond:
+            self.connected = False
+            # QoS 0 messages that didn't make it out are gone, paho resends the others itself
+            self.inflight.clear()
+            self.early.clear()
+
+    def _on_publish(self, client, userdata, mid):
+        with self.cond:
+            if mid in self.inflight:
+                self.inflight.remove(mid)
+            else:
+                self.early.add(mid)
+            self.cond.notify()
+
+    def pending(self):
+        with self.cond:
+            return sum(len(lane) for lane in self.lanes)
+
+    def _ready(self):
+        return self.connected and len(self.inflight) < self.maxInflight and any(self.lanes)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self._ready():
+                    self.cond.wait(1.0)
+                if not self.running:
+                    # send what's left, unless we can't get it out in time
+                    if not any(self.lanes) or time.monotonic() >= self.stopDeadline:
+                        break
+                    if not self._ready():
+                        self.cond.wait(0.1)
+                        continue
+                lane = next(lane for lane in self.lanes if lane)
+                message = lane.popleft()
+
+            # paho takes its own locks in publish() and holds them while calling on_publish, so not under ours
+            topic, payload, qos, retain, attempts, done = message
+            info = self.client.publish(topic, payload, qos, retain)
+
+            outcome = None
+            with self.cond:
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    if info.mid in self.early:
+                        self.early.remove(info.mid)
+                    else:
+                        self.inflight.add(info.mid)
+                    self.published += 1
+                    outcome = True
+                elif attempts < self.retries:
+                    message[4] += 1
+                    self.retried += 1
+                    lane.appendleft(message)
+                    # give the client a moment (a dropped connection is noticed by then)
+                    self.cond.wait(1.0)
+                else:
+                    myLog.error('Unable to publish to %s (error %d), giving up', topic, info.rc)
+                    self.failed += 1
+                    outcome = False
+
+            if done is not None and outcome is not None:
+                done(outcome)
+
+        remaining = self.pending()
+        if remaining:
+            myLog.warning('MQTT publisher stopped with %u messages unsent', remaining)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'queue_depth': [len(lane) for lane in self.lanes],
+                'inflight': len(self.inflight),
+                'published': self.published,
+                'dropped': self.dropped,
+                'retried': self.retried,
+                'failed': self.failed,
+            }
+
+    def shutdown(self, timeout=10.0):
+        # send whatever is queued (for up to timeout seconds), then disconnect
+        with self.cond:
+            self.running = False
+            self.stopDeadline = time.monotonic() + timeout
+            self.cond.notify()
+        self.join()
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class PeriodicThread(threading.Thread):
+    """ Calls func every interval seconds until shut down """
+
+    def __init__(self, name, interval, func):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.interval = interval
+        self.func = func
+        self.stopEvent = threading.Event()
+
+    def run(self):
+        while not self.stopEvent.wait(self.interval):
+            try:
+                self.func()
+            except:
+                myLog.exception('Error in %s', self.name)
+
+    def shutdown(self):
+        self.stopEvent.set()
+        self.join()
+
+
+class WindowAccumulator:
+    """ Running min/max/sum/last/count of one measurement over one window, in constant memory """
+
+    __slots__ = ('start', 'count', 'total', 'min', 'max', 'last')
+
+    def __init__(self, start, value):
+        self.start = start
+        self.count = 1
+        self.total = value
+        self.min = value
+        self.max = value
+        self.last = value
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.last = value
+
+
+class Aggregator:
+    """ Downsamples measurements into fixed, clock aligned windows per (gw, sensor, type, measurement)
+
+    The window length comes from windows[measurement], or windows['default'] (60 s if missing). A window is
+    emitted when a sample for a later window arrives, or by flush() once the window is over. Only used from
+    the aggregate worker.
+    """
+
+    def __init__(self, windows, emit):
+        self.windows = windows
+        self.defaultWindow = windows.get('default', 60)
+        self.emit = emit
+        # (gw, sensor, type, measurement) -> (window length, accumulator)
+        self.accumulators = {}
+
+    def add(self, m):
+        window = self.windows.get(m.measurement, self.defaultWindow)
+        ts = m.ts if m.ts is not None else time.time()
+        start = ts - ts % window
+        key = (m.gw, m.sensor, m.type, m.measurement)
+
+        entry = self.accumulators.get(key)
+        if entry is not None:
+            acc = entry[1]
+            if start <= acc.start:
+                # same window (late samples are folded into the current one)
+                acc.add(m.value)
+                return
+            # we've moved on to the next window
+            self.emit(key, acc)
+
+        self.accumulators[key] = (window, WindowAccumulator(start, m.value))
+
+    def flush(self, force=False):
+        # emit the windows that are over (or all of them when forced)
+        now = time.time()
+        for key, (window, acc) in list(self.accumulators.items()):
+            if force or acc.start + window <= now:
+                self.emit(key, acc)
+                del self.accumulators[key]
+
+
+class HaReplayThread(threading.Thread):
+    """ Sends a list of (kind, topic, payload, retain) messages to HA in paced chunks, until done or cancelled
+
+    Used when HA comes online: discovery configs go first, then the last known state of every node.
+    Dict payloads are serialised here, rather than on the HA worker.
+    """
+
+    def __init__(self, messages, chunkSize, chunkInterval):
+        threading.Thread.__init__(self, name='HaReplay', daemon=True)
+        self.messages = messages
+        self.chunkSize = chunkSize
+        self.chunkInterval = chunkInterval
+        self.cancelEvent = threading.Event()
+        self.sent = 0
+
+    def run(self):
+        total = len(self.messages)
+        myLog.info('Replaying %u messages to HA', total)
+
+        while self.sent < total:
+            for kind, topic, payload, retain in self.messages[self.sent:self.sent + self.chunkSize]:
+                if isinstance(payload, dict):
+                    payload = json.dumps(payload)
+                _publish(kind, topic, payload, 0, retain)
+                self.sent += 1
+                metricHaReplayed.inc()
+
+            # pace the chunks, so we don't flood the broker; stop early if we've been cancelled
+            if self.sent < total and self.cancelEvent.wait(self.chunkInterval):
+                myLog.info('HA replay cancelled after %u of %u messages', self.sent, total)
+                return
+
+        myLog.info('HA replay finished')
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def pending(self):
+        return len(self.messages) - self.sent
+
+
+class PipelineStage(threading.Thread):
+    """ One worker of the processing pipeline, with its own bounded queue
+
+    put() never blocks: when the queue is full the item is dropped (and counted), so a slow stage can't stall
+    whoever is feeding it, least of all the MQTT network loop.
+    """
+
+    def __init__(self, name, handler, queueSize):
+        threading.Thread.__init__(self, name=name)
+        self.handler = handler
+        self.queue = queue.Queue(queueSize)
+        self.statsLock = threading.Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+        self.processTotal = 0.0
+        self.processMax = 0.0
+        # set to a LatencyHistogram to count the processing latencies (used by the replay benchmark)
+        self.latencies = None
+
+    def put(self, item, block=False):
+        try:
+            self.queue.put((time.monotonic(), item), block)
+        except queue.Full:
+            with self.statsLock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            # None is our stop marker
+            if entry is None:
+                break
+
+            queuedAt, item = entry
+            start = time.monotonic()
+            try:
+                self.handler(item)
+                ok = True
+            except:
+                myLog.exception('Error in pipeline stage %s', self.name)
+                ok = False
+            end = time.monotonic()
+
+            with self.statsLock:
+                self.processed += 1
+                if not ok:
+                    self.errors += 1
+                self.waitTotal += start - queuedAt
+                self.waitMax = max(self.waitMax, start - queuedAt)
+                self.processTotal += end - start
+                self.processMax = max(self.processMax, end - start)
+                if self.latencies is not None:
+                    self.latencies.observe(end - start)
+
+    def stats(self):
+        with self.statsLock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'avg_wait': self.waitTotal / self.processed if self.processed else 0.0,
+                'max_wait': self.waitMax,
+                'avg_latency': self.processTotal / self.processed if self.processed else 0.0,
+                'max_latency': self.processMax,
+            }
+
+    def alive(self):
+        return self.is_alive()
+
+    def shutdown(self):
+        # queue the stop marker behind everything else, so pending items get processed
+        self.queue.put(None)
+        self.join()
+
+
+class AsyncPipelineStage:
+    """ PipelineStage for the asyncio runtime: a task draining a bounded asyncio queue
+
+    Same interface as PipelineStage. put() may also be called from other threads (timers, HA replay), the item
+    is then handed over to the event loop. Handlers run on the loop, so they must not block.
+    """
+
+    # items handled in a row before giving the other tasks a turn
+    BATCH = 100
+
+    def __init__(self, name, handler, queueSize):
+        self.name = name
+        self.handler = handler
+        self.queue = asyncio.Queue(queueSize)
+        self.loop = None
+        self.loopThread = None
+        self.task = None
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+        self.processTotal = 0.0
+        self.processMax = 0.0
+        self.latencies = None
+
+    def start(self):
+        # must be called from the event loop
+        self.loop = asyncio.get_running_loop()
+        self.loopThread = threading.get_ident()
+        self.task = self.loop.create_task(self.run())
+
+    def put(self, item, block=False):
+        if threading.get_ident() == self.loopThread:
+            self._put((time.monotonic(), item))
+        else:
+            self.loop.call_soon_threadsafe(self._put, (time.monotonic(), item))
+
+    def _put(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def run(self):
+        handled = 0
+        while True:
+            entry = await self.queue.get()
+            # None is our stop marker
+            if entry is None:
+                break
+
+            queuedAt, item = entry
+            start = time.monotonic()
+            try:
+                self.handler(item)
+            except:
+                myLog.exception('Error in pipeline stage %s', self.name)
+                self.errors += 1
+            end = time.monotonic()
+
+            self.processed += 1
+            self.waitTotal += start - queuedAt
+            self.waitMax = max(self.waitMax, start - queuedAt)
+            self.processTotal += end - start
+            self.processMax = max(self.processMax, end - start)
+            if self.latencies is not None:
+                self.latencies.observe(end - start)
+
+            # get() doesn't yield while there's something queued
+            handled += 1
+            if handled % self.BATCH == 0:
+                await asyncio.sleep(0)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'avg_wait': self.waitTotal / self.processed if self.processed else 0.0,
+            'max_wait': self.waitMax,
+            'avg_latency': self.processTotal / self.processed if self.processed else 0.0,
+            'max_latency': self.processMax,
+        }
+
+    def alive(self):
+        return self.task is not None and not self.task.done()
+
+    async def _stop(self):
+        await self.queue.put(None)
+        await self.task
+
+    def shutdown(self):
+        # called from a thread other than the loop's, waits until everything queued is processed
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+
+
+class AsyncMqttLoop:
+    """ Drives the paho client from an asyncio loop through its socket callbacks, instead of loop_forever()
+
+    Reading from the broker is paused while a decode queue is above HIGH_WATERMARK full and resumed once it's
+    below LOW_WATERMARK, so a backlog pushes back on the connection instead of dropping messages.
+    """
+
+    HIGH_WATERMARK = 0.9
+    LOW_WATERMARK = 0.5
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.loopThread = threading.get_ident()
+        self.client = client
+        self.sock = None
+        self.paused = False
+        self.stopping = False
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _call(self, func, *args):
+        # paho calls back from whichever thread publishes, the loop must only be touched from its own
+        if threading.get_ident() == self.loopThread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._open, sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self._close, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+    def _open(self, sock):
+        self.sock = sock
+        if not self.paused:
+            self.loop.add_reader(sock, self._on_readable)
+
+    def _close(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self.sock is sock:
+            self.sock = None
+
+    def _on_readable(self):
+        self.client.loop_read()
+        if self.sock is not None and not self.paused and self._backlog() >= self.HIGH_WATERMARK:
+            myLog.debug('Decode queue backlog, pausing MQTT reads')
+            self.pause()
+
+    def _backlog(self):
+        # fill level of the fullest decode queue
+        if pipelineQueueSize <= 0:
+            return 0.0
+        return max(stage.queue.qsize() for stage in decodeStages) / pipelineQueueSize
+
+    def pause(self):
+        self.paused = True
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+
+    def resume(self):
+        self.paused = False
+        if self.sock is not None:
+            self.loop.add_reader(self.sock, self._on_readable)
+
+    async def run(self):
+        # connect, then keep the connection alive (and reconnect when it drops) until stop()
+        while not self.stopping:
+            if self.client.socket() is None:
+                try:
+                    # connecting blocks on DNS and the TCP handshake
+                    await self.loop.run_in_executor(None, self.client.connect, mqttAddress, mqttPort)
+                except (OSError, ValueError):
+                    myLog.error("Unable to connect to MQTT, retrying in 5 seconds")
+                    await asyncio.sleep(5)
+                    continue
+
+            self.client.loop_misc()
+            if self.paused and not self.stopping and self._backlog() <= self.LOW_WATERMARK:
+                myLog.debug('Decode queue drained, resuming MQTT reads')
+                self.resume()
+            await asyncio.sleep(0.05 if self.paused else 1.0)
+
+    async def stop(self):
+        self.stopping = True
+        self.pause()
+        self.client.disconnect()
+        # give the DISCONNECT (and whatever was published before it) a moment to go out
+        for i in range(40):
+            if self.client.socket() is None or not self.client.want_write():
+                break
+            await asyncio.sleep(0.05)
+
+
+class ShardProcess:
+    """ One worker process started by the supervisor, restarted restartDelay seconds after it dies
+
+    The worker runs this script again with --shard, so it reads the same config file and only differs in the
+    gateways it handles and in the settings _apply_shard() changes.
+    """
+
+    def __init__(self, index, argv, restartDelay):
+        self.index = index
+        self.argv = argv
+        self.restartDelay = restartDelay
+        self.proc = None
+        self.exitedAt = None
+        self.restarts = 0
+
+    def start(self):
+        import subprocess
+
+        myLog.info('Starting worker %u', self.index)
+        # in its own session, so a Ctrl-C only reaches the supervisor (which then stops the workers in order)
+        self.proc = subprocess.Popen(self.argv, start_new_session=True)
+        self.exitedAt = None
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def check(self):
+        if self.alive():
+            return
+        now = time.monotonic()
+        if self.exitedAt is None:
+            myLog.error('Worker %u exited with code %s, restarting it in %u seconds', self.index, self.proc.returncode, self.restartDelay)
+            self.exitedAt = now
+        elif now - self.exitedAt >= self.restartDelay:
+            self.restarts += 1
+            self.start()
+
+    def signal(self, sig):
+        if self.alive():
+            self.proc.send_signal(sig)
+
+    def wait(self, timeout):
+        import subprocess
+
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            myLog.error('Worker %u did not stop in time, killing it', self.index)
+            self.proc.kill()
+            self.proc.wait()
+
+
+class HaMeasurementInfo(NamedTuple):
+    component: str      # HA component, sensor or binary_sensor
+    device_class: str   # HA device class
+    unit: str           # HA unit of measurement
+
+
+class HaStatePublisher:
+    """ Coalesces HA state updates per state topic and publishes one merged payload per topic on flush()
+
+    On flush, a topic is only published if one of its measurements has moved by more than its deadband since
+    the last publish (measurements without a deadband always count as moved), or if the last publish is more
+    than heartbeat seconds old (0 disables the heartbeat). The payload is the last published state updated with
+    everything received since, so HA always gets every measurement of the node. Only used from the HA worker.
+    """
+
+    def __init__(self, deadbands, heartbeat):
+        self.deadbands = deadbands
+        self.heartbeat = heartbeat
+        # state topic -> {measurement: value} received since the last flush
+        self.pending = {}
+        # state topic -> ({measurement: value}, time) last published
+        self.published = {}
+
+    def update(self, topic, measurement, value):
+        state = self.pending.get(topic)
+        if state is None:
+            state = self.pending[topic] = {}
+        state[measurement] = value
+
+    def flush(self):
+        now = time.monotonic()
+        pending, self.pending = self.pending, {}
+
+        for topic, state in pending.items():
+            last = self.published.get(topic)
+            if last is not None and not self._moved(last[0], state) and not (self.heartbeat and now - last[1] >= self.heartbeat):
+                metricHaStateSuppressed.inc()
+                continue
+
+            merged = dict(last[0]) if last is not None else {}
+            merged.update(state)
+            _publish('ha_state', topic, json.dumps(merged))
+            self.published[topic] = (merged, now)
+
+    def _moved(self, last, state):
+        for measurement, value in state.items():
+            deadband = self.deadbands.get(measurement)
+            if deadband is None or measurement not in last:
+                return True
+            try:
+                if abs(value - last[measurement]) > deadband:
+                    return True
+            except TypeError:
+                if value != last[measurement]:
+                    return True
+        return False
+
+
+class NodeState:
+    """ Arrival statistics of one (gw, sensor) """
+
+    __slots__ = ('lastSeen', 'interval', 'count', 'deadline', 'heapDeadline', 'online')
+
+    def __init__(self, now):
+        self.lastSeen = now
+        # average time between messages, None until we've had two
+        self.interval = None
+        self.count = 1
+        self.deadline = None
+        # deadline of the node's current heap entry, None if it has none
+        self.heapDeadline = None
+        self.online = True
+
+
+class NodeTracker:
+    """ Tracks when every (gw, sensor) was last heard from, and notices the ones that have gone quiet
+
+    A node's usual interval is an exponentially weighted average of the time between its messages. It's gone when
+    nothing arrived for multiple times that interval, kept between minTimeout and maxTimeout (maxTimeout until the
+    interval is known). Every online node has an entry in a heap ordered by deadline; when a node was heard from
+    after its entry was pushed, the entry is only moved to the new deadline once it comes up (or right away if the
+    deadline got earlier), so expire() touches the entries that are due rather than all the nodes.
+    onChange(key, online) is called when a node appears, goes quiet or comes back. Only used from the HA worker.
+    """
+
+    # weight of the latest interval in the average
+    ALPHA = 0.2
+
+    def __init__(self, multiple, minTimeout, maxTimeout, onChange):
+        self.multiple = multiple
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        self.onChange = onChange
+        self.nodes = {}
+        # (deadline, key)
+        self.heap = []
+        self.offline = 0
+
+    def _timeout(self, node):
+        if node.interval is None:
+            return self.maxTimeout
+        return min(self.maxTimeout, max(self.minTimeout, node.interval * self.multiple))
+
+    def add(self, key, now=None, restored=False):
+        # a node restored from a snapshot has maxTimeout to show up. It's not been heard from yet (count 0), so its
+        # first message still announces it, HA may have it unavailable from before the restart
+        node = self.nodes[key] = NodeState(time.monotonic() if now is None else now)
+        if restored:
+            node.count = 0
+        node.deadline = node.lastSeen + self._timeout(node)
+        self._push(key, node)
+        return node
+
+    def _push(self, key, node):
+        node.heapDeadline = node.deadline
+        heapq.heappush(self.heap, (node.deadline, key))
+
+    def seen(self, key, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        node = self.nodes.get(key)
+        if node is None:
+            self.add(key, now)
+            self.onChange(key, True)
+            return
+
+        if node.count:
+            # the time since a restore isn't an interval
+            elapsed = now - node.lastSeen
+            node.interval = elapsed if node.interval is None else node.interval + self.ALPHA * (elapsed - node.interval)
+        node.lastSeen = now
+        node.count += 1
+        node.deadline = now + self._timeout(node)
+
+        if not node.online:
+            # nodes that are offline have no heap entry
+            node.online = True
+            self.offline -= 1
+            self._push(key, node)
+            self.onChange(key, True)
+            return
+
+        if node.count == 1:
+            # first message of a restored node
+            self.onChange(key, True)
+        if node.deadline < node.heapDeadline:
+            # the interval has shrunk, the old entry would come up too late (it's skipped when it does)
+            self._push(key, node)
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            node = self.nodes[key]
+            if deadline != node.heapDeadline:
+                # replaced by an earlier entry
+                continue
+            if node.deadline > now:
+                # heard from since, check again at the new deadline
+                self._push(key, node)
+            else:
+                node.heapDeadline = None
+                node.online = False
+                self.offline += 1
+                self.onChange(key, False)
+
+    def stats(self):
+        return {'tracked': len(self.nodes), 'offline': self.offline}
+
+
+class SensorRecord:
+    """ What we know about one (gw, sensor, measurement), with the HA topics and discovery payload precomputed """
+
+    __slots__ = ('gw', 'sensor', 'type', 'measurement', 'value', 'lastSeen', 'provisioned', 'provisioning',
+                 'stateTopic', 'discoveryTopic', 'discoveryPayload')
+
+    def __init__(self, sensor_data):
+        self.gw = sensor_data.gw
+        self.sensor = sensor_data.sensor
+        self.type = sensor_data.type
+        self.measurement = sensor_data.measurement
+        self.value = sensor_data.value
+        self.lastSeen = sensor_data.ts
+        self.provisioned = False
+        # the discovery payload on its way to the broker, None if there's none
+        self.provisioning = None
+        self.stateTopic = _ha_state_topic(sensor_data.gw, sensor_data.sensor)
+        self.discoveryTopic, self.discoveryPayload = build_discovery(sensor_data)
+
+    @property
+    def key(self):
+        return (self.gw, self.sensor, self.measurement)
+
+
+def _discovery_hash(payload):
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class SensorRegistry:
+    """ All measurements we've seen, keyed by (gw, sensor, measurement)
+
+    Records are also indexed by gateway and by HA state topic (all measurements of a node share one state
+    topic). Not thread safe: it's only used from the HA worker.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.byGateway = {}
+        self.byStateTopic = {}
+        self.lastSaved = time.monotonic()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def add(self, sensor_data):
+        record = SensorRecord(sensor_data)
+        self.records[record.key] = record
+        self.byGateway.setdefault(record.gw, []).append(record)
+        self.byStateTopic.setdefault(record.stateTopic, []).append(record)
+        return record
+
+    def save(self, fileName):
+        # snapshot to a file; written to a temporary file first, so a crash never leaves a half written snapshot
+        snapshot = []
+        for r in self.records.values():
+            snapshot.append({
+                'gw': r.gw,
+                'sensor': r.sensor,
+                'type': r.type,
+                'measurement': r.measurement,
+                'value': r.value,
+                'last_seen': r.lastSeen,
+                'provisioned': r.provisioned,
+                'discovery_hash': _discovery_hash(r.discoveryPayload),
+            })
+
+        if os.path.dirname(fileName):
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+        tmpName = fileName + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmpName, fileName)
+        self.lastSaved = time.monotonic()
+
+    def load(self, fileName):
+        # restore a snapshot; a measurement only counts as provisioned if its discovery payload hasn't changed
+        with open(fileName, 'r') as f:
+            snapshot = json.load(f)
+
+        changed = 0
+        for s in snapshot:
+            record = self.add(SensorData(s['gw'], s['sensor'], s['type'], s['measurement'], s['value'], s['last_seen']))
+            record.provisioned = s['provisioned'] and s['discovery_hash'] == _discovery_hash(record.discoveryPayload)
+            if s['provisioned'] and not record.provisioned:
+                changed += 1
+        return changed
 
 
 class SensorData(NamedTuple):
@@ -86,16 +2050,372 @@ class SensorData(NamedTuple):
     type: int           # sensor type
     measurement: str    # name of the measurement, e.g. power1, temp, etc
     value: float        # value of the measurmement
+    ts: float = None    # time the message was received (epoch seconds)
+
+
+class Metric:
+    """ A minimal Prometheus style metric, with optional labels
+
+    Values are kept per label value tuple; samples() yields (suffix, label names, label values, value) for rendering.
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield '', self.labelNames, labels, value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    # default buckets in seconds, tuned for our decode and write latencies
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help, labelNames=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labelNames)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # per bucket counts (the last one is +Inf), sum, count
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
 
+    def samples(self):
+        with self.lock:
+            items = [(labels, (list(state[0]), state[1], state[2])) for labels, state in self.values.items()]
+        names = self.labelNames + ('le',)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float('inf'),), counts):
+                cumulative += c
+                yield '_bucket', names, labels + ('+Inf' if bound == float('inf') else repr(bound),), cumulative
+            yield '_sum', self.labelNames, labels, total
+            yield '_count', self.labelNames, labels, count
 
-@app.route('/status')
-def hello_world():
-    # right now just return 'running' with a 200 status
-    return 'running'
+
+class CallbackMetric(Metric):
+    """ A metric whose values are owned by something else (queue depths, drop counters) and read at scrape time """
+
+    def __init__(self, name, help, type, labelNames, callback):
+        Metric.__init__(self, name, help, labelNames)
+        self.type = type
+        self.callback = callback
+
+    def samples(self):
+        for labels, value in self.callback().items():
+            yield '', self.labelNames, labels, value
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics():
+    # Prometheus text exposition format
+    lines = []
+    for metric in METRICS:
+        lines.append('# HELP ' + metric.name + ' ' + metric.help)
+        lines.append('# TYPE ' + metric.name + ' ' + metric.type)
+        for suffix, names, labels, value in metric.samples():
+            if names:
+                labelText = '{' + ','.join(n + '="' + _escape_label(v) + '"' for n, v in zip(names, labels)) + '}'
+            else:
+                labelText = ''
+            lines.append(metric.name + suffix + labelText + ' ' + repr(float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _queue_depths():
+    depths = {(stage.name,): stage.queue.qsize() for stage in _pipeline_stages()}
+    if influxWriter is not None:
+        depths[('influxdb',)] = influxWriter.queue.qsize()
+    if captureWriter is not None:
+        depths[('capture',)] = captureWriter.queue.qsize()
+    if mqttPublisher is not None:
+        depths[('publish',)] = mqttPublisher.pending()
+    return depths
+
+
+def _queue_drops():
+    drops = {(stage.name,): stage.dropped for stage in _pipeline_stages()}
+    if influxWriter is not None:
+        drops[('influxdb',)] = influxWriter.dropped
+    if captureWriter is not None:
+        drops[('capture',)] = captureWriter.dropped
+    if mqttPublisher is not None:
+        drops[('publish',)] = mqttPublisher.dropped + mqttPublisher.failed
+    return drops
+
+
+metricMessagesReceived = Counter('rfm69gw_messages_received_total', 'Gateway messages received', ('gateway',))
+metricMessagesDecoded = Counter('rfm69gw_messages_decoded_total', 'Gateway payloads decoded', ('gateway', 'sensor_type'))
+metricMessagesRejected = Counter('rfm69gw_messages_rejected_total', 'Gateway payloads that could not be decoded', ('gateway', 'reason'))
+metricDuplicatesSuppressed = Counter('rfm69gw_duplicates_suppressed_total', 'Packets dropped because another gateway heard them first', ('gateway',))
+metricDecodeSeconds = Histogram('rfm69gw_decode_seconds', 'Time spent decoding a message')
+metricInfluxWriteSeconds = Histogram('rfm69gw_influxdb_write_seconds', 'Time spent writing a batch to InfluxDB')
+metricInfluxWriteErrors = Counter('rfm69gw_influxdb_write_errors_total', 'Failed InfluxDB batch writes')
+metricInfluxPointsWritten = Counter('rfm69gw_influxdb_points_written_total', 'Points written to InfluxDB')
+metricInfluxPointsSpooled = Counter('rfm69gw_influxdb_points_spooled_total', 'Points spooled to disk while InfluxDB was unavailable')
+metricInfluxPointsBackfilled = Counter('rfm69gw_influxdb_points_backfilled_total', 'Spooled points written to InfluxDB')
+metricInfluxSpoolBytes = CallbackMetric('rfm69gw_influxdb_spool_bytes', 'Bytes of points waiting in the InfluxDB spool', 'gauge', (),
+                                        lambda: {(): influxWriter.spool.size if influxWriter is not None and influxWriter.spool is not None else 0})
+metricMqttPublished = Counter('rfm69gw_mqtt_published_total', 'MQTT messages published', ('kind',))
+metricHaProvisioned = Counter('rfm69gw_ha_provisioned_total', 'Sensors provisioned in Home Assistant')
+metricHaReplayed = Counter('rfm69gw_ha_replayed_total', 'Messages re-sent to Home Assistant after it came online')
+metricHaReplayCancelled = Counter('rfm69gw_ha_replay_cancelled_total', 'HA replays cancelled before they finished')
+metricHaReplayPending = CallbackMetric('rfm69gw_ha_replay_pending', 'Messages still waiting to be re-sent to Home Assistant', 'gauge', (),
+                                       lambda: {(): haReplay.pending() if haReplay is not None and haReplay.is_alive() else 0})
+metricHaStateSuppressed = Counter('rfm69gw_ha_state_suppressed_total', 'HA state updates not published because nothing moved past its deadband')
+metricNodesExpired = Counter('rfm69gw_nodes_expired_total', 'Nodes marked unavailable because they went quiet')
+metricNodesOffline = CallbackMetric('rfm69gw_nodes_offline', 'Nodes currently marked unavailable', 'gauge', (),
+                                    lambda: {(): nodeTracker.offline if nodeTracker is not None else 0})
+metricQueueDepth = CallbackMetric('rfm69gw_queue_depth', 'Items waiting in a queue', 'gauge', ('stage',), _queue_depths)
+metricQueueDropped = CallbackMetric('rfm69gw_queue_dropped_total', 'Items dropped because a queue was full', 'counter', ('stage',), _queue_drops)
+
+# everything exported on /metrics
+METRICS = [
+    metricMessagesReceived,
+    metricMessagesDecoded,
+    metricMessagesRejected,
+    metricDuplicatesSuppressed,
+    metricDecodeSeconds,
+    metricInfluxWriteSeconds,
+    metricInfluxPointsSpooled,
+    metricInfluxPointsBackfilled,
+    metricInfluxSpoolBytes,
+    metricInfluxWriteErrors,
+    metricInfluxPointsWritten,
+    metricMqttPublished,
+    metricHaProvisioned,
+    metricHaStateSuppressed,
+    metricHaReplayed,
+    metricHaReplayCancelled,
+    metricHaReplayPending,
+    metricNodesExpired,
+    metricNodesOffline,
+    metricQueueDepth,
+    metricQueueDropped,
+]
+
+
+def _stats_data():
+    # internal counters, useful for tuning queue and batch sizes
+    data = {}
+    data['pipeline'] = {stage.name: stage.stats() for stage in _pipeline_stages()}
+    if influxWriter is not None:
+        data['influxdb'] = influxWriter.stats()
+    if captureWriter is not None:
+        data['capture'] = captureWriter.stats()
+    if mqttPublisher is not None:
+        data['publish'] = mqttPublisher.stats()
+    data['routes'] = topicRouter.stats()
+    if duplicateFilter is not None:
+        data['dedup'] = duplicateFilter.stats()
+    if sensorRegistry is not None:
+        data['registry'] = {'measurements': len(sensorRegistry), 'gateways': len(sensorRegistry.byGateway), 'nodes': len(sensorRegistry.byStateTopic)}
+    if nodeTracker is not None:
+        data['availability'] = nodeTracker.stats()
+    return data
+
+
+def _health_data():
+    # healthy: the pipeline workers are running and (if health_max_message_age is set) messages are coming in;
+    # ready: on top of that we're connected to MQTT and the sinks are working
+    now = time.monotonic()
+    messageAge = now - (lastMessageAt if lastMessageAt is not None else startedAt)
+    data = {
+        'mqtt_connected': mqttConnected,
+        'last_message_age': now - lastMessageAt if lastMessageAt is not None else None,
+        'workers_alive': all(stage.alive() for stage in _pipeline_stages()),
+        'sinks': {},
+    }
+
+    if influxWriter is not None:
+        s = influxWriter.stats()
+        data['sinks']['influxdb'] = {'ok': influxWriter.lastWriteOk is not False, 'errors': s['errors'],
+                                     'error_rate': s['errors'] / s['batches'] if s['batches'] else 0.0}
+    if mqttPublisher is not None:
+        s = mqttPublisher.stats()
+        lost = s['dropped'] + s['failed']
+        data['sinks']['publish'] = {'ok': mqttPublisher.connected, 'errors': lost,
+                                    'error_rate': lost / (s['published'] + lost) if s['published'] + lost else 0.0}
+
+    data['healthy'] = data['workers_alive'] and not (healthMaxMessageAge and messageAge > healthMaxMessageAge)
+    data['ready'] = data['healthy'] and mqttConnected and all(sink['ok'] for sink in data['sinks'].values())
+    return data
+
+
+def _api_response(path):
+    # every route of our API server, returns (status, content type, body)
+    if path == '/status':
+        return 200, 'text/html; charset=utf-8', 'running'
+    if path in ('/health', '/ready'):
+        data = _health_data()
+        ok = data['healthy'] if path == '/health' else data['ready']
+        return 200 if ok else 503, 'application/json', json.dumps(data)
+    if path == '/stats':
+        return 200, 'application/json', json.dumps(_stats_data())
+    if path == '/metrics':
+        return 200, 'text/plain; version=0.0.4', render_metrics()
+    return 404, 'text/plain', 'Not Found'
+
+
+def _supervisor_response(path):
+    # the supervisor's API: the same routes, combining what the workers answer
+    if path in ('/status', '/health', '/ready'):
+        # only OK if every worker is up and says so
+        for worker in shardWorkers:
+            if not worker.alive() or _shard_request(worker.index, path) is None:
+                return 503, 'text/plain', 'worker ' + str(worker.index) + ' is down or not ' + path[1:]
+        return 200, 'text/plain', 'running'
+    if path == '/stats':
+        data = {}
+        for worker in shardWorkers:
+            body = _shard_request(worker.index, '/stats')
+            data[str(worker.index)] = {'alive': worker.alive(), 'restarts': worker.restarts, 'stats': json.loads(body) if body is not None else None}
+        return 200, 'application/json', json.dumps({'workers': data})
+    if path == '/metrics':
+        return 200, 'text/plain; version=0.0.4', _supervisor_metrics()
+    return 404, 'text/plain', 'Not Found'
+
+
+def _supervisor_metrics():
+    texts = {}
+    for worker in shardWorkers:
+        body = _shard_request(worker.index, '/metrics')
+        if body is not None:
+            texts[worker.index] = body
+
+    text = _merge_shard_metrics(texts)
+    text += '# HELP rfm69gw_worker_up Whether a worker process is running\n# TYPE rfm69gw_worker_up gauge\n'
+    text += ''.join('rfm69gw_worker_up{shard="%u"} %s\n' % (w.index, repr(float(w.alive()))) for w in shardWorkers)
+    text += '# HELP rfm69gw_worker_restarts_total Worker processes restarted after they died\n# TYPE rfm69gw_worker_restarts_total counter\n'
+    text += ''.join('rfm69gw_worker_restarts_total{shard="%u"} %s\n' % (w.index, repr(float(w.restarts))) for w in shardWorkers)
+    return text
+
+
+def _shard_api_port(index):
+    # workers listen on the ports following the main API port
+    return apiPort + 1 + index
+
+
+def _shard_request(index, path):
+    # body of a worker's answer, None if it's down or didn't answer with a 200
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:%u%s' % (_shard_api_port(index), path), timeout=2) as r:
+            return r.read().decode('utf-8')
+    except (OSError, ValueError):
+        return None
+
+
+def _add_shard_label(line, index):
+    # sample lines are 'name value' or 'name{labels} value'
+    brace = line.find('{')
+    space = line.find(' ')
+    if brace != -1 and brace < space:
+        return line[:brace + 1] + 'shard="%u",' % index + line[brace + 1:]
+    return line[:space] + '{shard="%u"}' % index + line[space:]
+
+
+def _merge_shard_metrics(texts):
+    # combine the workers' /metrics into one exposition: every sample gets a shard label, and the samples of a
+    # metric stay together under a single HELP and TYPE, as Prometheus expects
+    families = {}
+    for index, text in texts.items():
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ', 3)[2]
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = [line]
+                    header = True
+                else:
+                    header = False
+            elif line.startswith('# TYPE '):
+                if header:
+                    family.append(line)
+            elif line and family is not None:
+                family.append(_add_shard_label(line, index))
+
+    return ''.join(line + '\n' for family in families.values() for line in family)
+
+
+async def _serve_api_request(reader, writer):
+    # just enough HTTP/1.0 for health checks and Prometheus: GET only, one request per connection
+    import http
+
+    try:
+        requestLine = await asyncio.wait_for(reader.readline(), 10)
+        while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = requestLine.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] in ('GET', 'HEAD'):
+            status, contentType, body = _api_response(parts[1].split('?', 1)[0])
+        else:
+            status, contentType, body = 405, 'text/plain', 'Method Not Allowed'
+        body = body.encode('utf-8')
+        reason = http.HTTPStatus(status).phrase
+        writer.write(('HTTP/1.0 %u %s\r\nContent-Type: %s\r\nContent-Length: %u\r\nConnection: close\r\n\r\n' % (status, reason, contentType, len(body))).encode('latin-1'))
+        if parts and parts[0] != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+    except (asyncio.TimeoutError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+def _load_config_file(confFile):
+    config = configparser.ConfigParser()
+    if confFile:
+        myLog.info('Using config file: ' + confFile)
+        config.read(confFile, encoding='utf-8')
+    else:
+        config.read('/app/rfm69gw-decoder.conf', encoding='utf-8')
+    return config
+
+
+def _read_debug_trace(config):
+    # gateways are matched without the colons, like they're reported everywhere else
+    gateways = [str(gw).replace(':', '') for gw in json.loads(config.get('main', 'debug_gateways', fallback='[]'))]
+    sensors = [str(sensor) for sensor in json.loads(config.get('main', 'debug_sensors', fallback='[]'))]
+    return DebugTrace(myLog.getChild('debug'), gateways, sensors,
+                      config.getint('main', 'debug_sample', fallback=1), config.getint('main', 'debug_rate', fallback=0))
 
 
 def readConfig(confFile):
     global logLevel
+    global logFormat
+    global debugTrace
+    global healthMaxMessageAge
+    global apiAddress
     global apiPort
 
     global influxDbEnabled
@@ -104,6 +2424,21 @@ def readConfig(confFile):
     global influxDbUser
     global influxDbPassword
     global influxDbDatabase
+    global influxDbBatchSize
+    global influxDbFlushInterval
+    global influxDbQueueSize
+    global influxDbDropPolicy
+    global influxDbWriteMode
+    global influxDbAggregateWindows
+    global influxDbAggregateSuffix
+    global influxDbGzipLevel
+    global influxDbTimeout
+    global influxDbSpoolDirectory
+    global influxDbSpoolSegmentSize
+    global influxDbSpoolMaxSize
+    global influxDbRetryInterval
+    global influxDbBackfillRate
+    global influxDbLogRssi
 
     global mqttAddress
     global mqttPort
@@ -112,26 +2447,59 @@ def readConfig(confFile):
     global mqttTopic
     global mqttRegex
     global mqttClientId
+    global mqttPublishMaxInflight
+    global mqttPublishQueueSize
+    global mqttPublishRetries
+    global topicRouter
 
     global rebroadcastEnabled
-    global rebroadcastSensors
     global rebroadcastTopic
+    global rebroadcastRules
 
     global haIntegrationEnabled
     global haBaseTopic
     global haStatusTopic
+    global haStateFile
+    global haSnapshotInterval
+    global haPublishWindow
+    global haDeadbands
+    global haHeartbeat
+    global haReplayChunkSize
+    global haReplayChunkInterval
+    global haAvailabilityMultiple
+    global haAvailabilityMinTimeout
+    global haAvailabilityMaxTimeout
+
+    global pipelineDecodeWorkers
+    global pipelineQueueSize
+    global pipelineRuntime
+    global pipelineProcesses
+    global pipelineDedupWindow
+
+    global captureEnabled
+    global captureDirectory
+    global captureMaxSize
+    global captureRotateInterval
+    global captureKeep
+    global captureQueueSize
+
+    global configFile
+    global nodeDecoders
 
     myLog.info('Reading configuration file')
 
-    config = configparser.ConfigParser()
-    if confFile:
-        myLog.info('Using config file: ' + confFile)
-        config.read(confFile)
-    else:
-        config.read('/app/rfm69gw-decoder.conf')
+    configFile = confFile
+    config = _load_config_file(confFile)
 
     logLevel = config.get('main', 'loglevel', fallback='ERROR')
+    logFormat = config.get('main', 'logformat', fallback='text')
+    if logFormat not in ('text', 'json'):
+        myLog.warning('Unknown log format %s, using text', logFormat)
+        logFormat = 'text'
+    debugTrace = _read_debug_trace(config)
+    apiAddress = config.get('main', 'apiaddress', fallback='127.0.0.1')
     apiPort = config.getint('main', 'apiport', fallback=5000)
+    healthMaxMessageAge = config.getint('main', 'health_max_message_age', fallback=0)
 
     mqttAddress = config.get('mqtt', 'address', fallback='192.168.0.254')
     mqttPort = config.getint('mqtt', 'port', fallback=1883)
@@ -140,31 +2508,108 @@ def readConfig(confFile):
     mqttTopic = config.get('mqtt', 'topic', fallback='RFM69Gw/+/+/+')
     mqttRegex = config.get('mqtt', 'regex', fallback='RFM69Gw/([^/]+)/([^/]+)/([^/]+)')
     mqttClientId = config.get('mqtt', 'clientId', fallback='RFM69GwToInfluxDBBridge')
+    mqttPublishMaxInflight = max(1, config.getint('mqtt', 'publish_max_inflight', fallback=20))
+    mqttPublishQueueSize = config.getint('mqtt', 'publish_queue_size', fallback=10000)
+    mqttPublishRetries = config.getint('mqtt', 'publish_retries', fallback=3)
+    topicRouter = TopicRouter(mqttRegex)
 
     influxDbEnabled = config.getboolean('influxdb', 'enabled', fallback=False)
     influxDbAddress = config.get('influxdb', 'address', fallback='192.168.0.254')
-    influxDbPassword = config.getint('influxdb', 'port', fallback=8086)
+    influxDbPort = config.getint('influxdb', 'port', fallback=8086)
     influxDbUser = config.get('influxdb', 'user', fallback='root')
     influxDbPassword = config.get('influxdb', 'password', fallback='root')
     influxDbDatabase = config.get('influxdb', 'database', fallback='home_iot')
+    influxDbBatchSize = config.getint('influxdb', 'batch_size', fallback=500)
+    influxDbFlushInterval = config.getfloat('influxdb', 'flush_interval', fallback=1.0)
+    influxDbQueueSize = config.getint('influxdb', 'queue_size', fallback=10000)
+    influxDbDropPolicy = config.get('influxdb', 'drop_policy', fallback='drop_oldest')
+    if influxDbDropPolicy not in ('drop_oldest', 'drop_newest', 'block'):
+        myLog.warning('Unknown InfluxDB drop policy %s, using drop_oldest', influxDbDropPolicy)
+        influxDbDropPolicy = 'drop_oldest'
+    influxDbWriteMode = config.get('influxdb', 'write_mode', fallback='raw')
+    if influxDbWriteMode not in ('raw', 'aggregate', 'both'):
+        myLog.warning('Unknown InfluxDB write mode %s, using raw', influxDbWriteMode)
+        influxDbWriteMode = 'raw'
+    influxDbAggregateWindows = json.loads(config.get('influxdb', 'aggregate_windows', fallback='{}'))
+    influxDbAggregateSuffix = config.get('influxdb', 'aggregate_suffix', fallback='_agg')
+    influxDbGzipLevel = config.getint('influxdb', 'gzip_level', fallback=6)
+    influxDbTimeout = config.getfloat('influxdb', 'timeout', fallback=10.0)
+    influxDbSpoolDirectory = config.get('influxdb', 'spool_directory', fallback='')
+    influxDbSpoolSegmentSize = config.getint('influxdb', 'spool_segment_size', fallback=4194304)
+    influxDbSpoolMaxSize = config.getint('influxdb', 'spool_max_size', fallback=268435456)
+    influxDbRetryInterval = config.getfloat('influxdb', 'retry_interval', fallback=5.0)
+    influxDbBackfillRate = config.getint('influxdb', 'backfill_rate', fallback=5000)
+    influxDbLogRssi = config.getboolean('influxdb', 'log_rssi', fallback=False)
 
     rebroadcastEnabled = config.getboolean('rebroadcast', 'enabled', fallback=False)
-    rebroadcastSensors = json.loads(config.get('rebroadcast', 'sensor_list', fallback=[]))
     rebroadcastTopic = config.get('rebroadcast', 'topic', fallback='RFM69Bridge')
+    try:
+        rebroadcastRules = _read_rebroadcast_rules(config)
+    except ValueError as e:
+        myLog.critical('%s', e)
+        sys.exit(1)
 
     haIntegrationEnabled = config.getboolean('ha_integration', 'enabled', fallback=False)
     haBaseTopic = config.get('ha_integration', 'base_topic', fallback='rfm69gw-decoder')
     haStatusTopic = config.get('ha_integration', 'ha_status_topic', fallback='homeassistant/status')
+    haStateFile = config.get('ha_integration', 'state_file', fallback='')
+    haSnapshotInterval = config.getint('ha_integration', 'snapshot_interval', fallback=300)
+    haPublishWindow = config.getfloat('ha_integration', 'publish_window', fallback=0)
+    haDeadbands = json.loads(config.get('ha_integration', 'deadband', fallback='{}'))
+    haHeartbeat = config.getint('ha_integration', 'heartbeat', fallback=0)
+    haReplayChunkSize = max(1, config.getint('ha_integration', 'replay_chunk_size', fallback=50))
+    haReplayChunkInterval = config.getfloat('ha_integration', 'replay_chunk_interval', fallback=0.5)
+    haAvailabilityMultiple = config.getfloat('ha_integration', 'availability_multiple', fallback=0)
+    haAvailabilityMinTimeout = config.getint('ha_integration', 'availability_min_timeout', fallback=60)
+    haAvailabilityMaxTimeout = config.getint('ha_integration', 'availability_max_timeout', fallback=3600)
+
+    pipelineDecodeWorkers = max(1, config.getint('pipeline', 'decode_workers', fallback=1))
+    pipelineQueueSize = config.getint('pipeline', 'queue_size', fallback=10000)
+    pipelineRuntime = config.get('pipeline', 'runtime', fallback='threads')
+    if pipelineRuntime not in ('threads', 'asyncio'):
+        myLog.warning('Unknown pipeline runtime %s, using threads', pipelineRuntime)
+        pipelineRuntime = 'threads'
+    if pipelineRuntime == 'asyncio' and influxDbDropPolicy == 'block':
+        # put() is called from the event loop, it must never block
+        myLog.warning('The block drop policy is not supported by the asyncio runtime, using drop_oldest')
+        influxDbDropPolicy = 'drop_oldest'
+    pipelineProcesses = max(1, config.getint('pipeline', 'processes', fallback=1))
+    pipelineDedupWindow = config.getfloat('pipeline', 'dedup_window', fallback=0)
+
+    captureEnabled = config.getboolean('capture', 'enabled', fallback=False)
+    captureDirectory = config.get('capture', 'directory', fallback='/app/capture')
+    captureMaxSize = int(config.getfloat('capture', 'max_size', fallback=10) * 1024 * 1024)
+    captureRotateInterval = config.getint('capture', 'rotate_interval', fallback=3600)
+    captureKeep = max(1, config.getint('capture', 'keep', fallback=24))
+    captureQueueSize = config.getint('capture', 'queue_size', fallback=10000)
+
+    try:
+        nodeDecoders = _compile_node_decoders(_read_node_layouts(config))
+    except (ValueError, TypeError) as e:
+        myLog.critical('Invalid node type configuration: %s', e)
+        sys.exit(1)
+    myLog.info('Loaded %u node types', len(nodeDecoders))
+
+
+def _publish(kind, topic, payload, qos=0, retain=False, done=None):
+    # every outgoing MQTT message goes through here, so we can count them. Returns whether it was accepted,
+    # done(ok) is called once it's been handed to the broker connection (or given up on)
+    metricMqttPublished.inc(kind)
+    if mqttPublisher is not None:
+        return mqttPublisher.put(kind, topic, payload, qos, retain, done)
+
+    mqtt_client.publish(topic, payload, qos, retain)
+    if done is not None:
+        done(True)
+    return True
 
 
 def on_connect(client, userdata, flags, rc):
     # The callback for when the client receives a CONNACK response from the server.
-    myLog.info('Connected to MQTT with result code %s', str(rc))
+    global mqttConnected
 
-    # if HA integration is enabled, we need to send a birth message
-    if haIntegrationEnabled:
-        mqtt_client.publish(haBaseTopic + '/status', 'online', 0, True)
-        myLog.debug('Sending birth message to HA')
+    myLog.info('Connected to MQTT with result code %s', str(rc))
+    mqttConnected = rc == 0
 
     # subscribe to the RFM69Gw topic
     client.subscribe(mqttTopic)
@@ -172,345 +2617,474 @@ def on_connect(client, userdata, flags, rc):
     client.subscribe(haStatusTopic)
 
 
+def on_disconnect(client, userdata, rc):
+    global mqttConnected
+
+    myLog.warning('Disconnected from MQTT with result code %s', str(rc))
+    mqttConnected = False
+
+
+def on_publisher_connect(client, userdata, flags, rc):
+    myLog.info('MQTT publisher connected with result code %s', str(rc))
+    if rc != 0:
+        return
+
+    # if HA integration is enabled, we need to send a birth message
+    if haIntegrationEnabled and _owns_ha_status():
+        _publish('ha_status', haBaseTopic + '/status', 'online', 0, True)
+        myLog.debug('Sending birth message to HA')
+    mqttPublisher.set_connected()
+
+
 def on_message(client, userdata, msg):
+    global lastMessageAt
+
     # The callback for when a PUBLISH message is received from the server.
-    myLog.debug('MQTT receive: %s %s', msg.topic, str(msg.payload))
+    # Only hand the message over to a decode worker here, so the network loop is never held up. A topic always
+    # goes to the same worker, so messages from a node are processed in order.
+    lastMessageAt = time.monotonic()
+
+    # with several worker processes, the other gateways are someone else's
+    if shardIndex is not None and _topic_shard(msg.topic) != shardIndex:
+        return
+
+    recvTs = time.time()
+
+    # record the raw traffic, if enabled (duplicates included, so a replay sees what we saw)
+    if captureWriter is not None:
+        captureWriter.put(msg.topic, msg.payload, recvTs)
+
+    if _is_duplicate(msg.topic, msg.payload, recvTs):
+        return
+
+    decodeStages[hash(msg.topic) % len(decodeStages)].put((msg.topic, msg.payload, recvTs))
+
+
+def _is_duplicate(topic, payload, recvTs):
+    # the same packet heard by several gateways is only processed once, whichever gateway's copy came first.
+    # The payload starts with the radio ID, so it's the (radio ID, payload) key on its own
+    if duplicateFilter is None:
+        return False
+    route = topicRouter.route(topic)
+    if route is None or route.kind != 'payload' or duplicateFilter.first(payload, recvTs):
+        return False
+    metricDuplicatesSuppressed.inc(route.gw)
+    return True
+
+
+def _topic_shard(topic):
+    # all messages of a gateway go to the same worker, so they're processed in order; topics that aren't from a
+    # gateway (HA status) go to every worker
+    route = topicRouter.route(topic)
+    if route is None:
+        return shardIndex
+    # hash() is salted per process, crc32 gives every worker the same answer
+    return zlib.crc32(route.gw.encode('utf-8')) % pipelineProcesses
+
+
+def _owns_ha_status():
+    # with several worker processes, only the first one sends the birth and last will messages
+    return shardIndex is None or shardIndex == 0
+
+
+def _decode_message(item):
+    topic, payload, recvTs = item
 
     # let's see what we got
-    if msg.topic == haStatusTopic:
-        # if HA is coming online, then we need to re-publish all of the sensors
-        if msg.payload.decode("utf-8")  == 'online':
-            myLog.info('HA is starting; send previous measurements')
-
-            data_json = {}
-            for g in provisionedSensors:
-                for s in provisionedSensors[g]:
-                    for m in provisionedSensors[g][s]:
-                        sens = SensorData(g, s, -1, m, provisionedSensors[g][s][m]['value'])
-                        try:
-                            data_json[haBaseTopic + '/' + g + '/' + str(s)][m] = provisionedSensors[g][s][m]['value']
-                        except KeyError:
-                            # looks like we're missing the base key
-                            data_json[haBaseTopic + '/' + g + '/' + str(s)] = {}
-                            data_json[haBaseTopic + '/' + g + '/' + str(s)][m] = provisionedSensors[g][s][m]['value']
-
-            # send the last measurement to HA
-            myLog.debug('Sending measurements to HA:\n%s', json.dumps(data_json))
-            for k in data_json:
-                mqtt_client.publish(k, json.dumps(data_json[k]))
-        else:
-            myLog.info('HA is stopping; no need to do anything')
+    if topic == haStatusTopic:
+        myLog.debug('HA status: %s', payload)
+        # HA status changes are handled by the HA worker, in order with the measurements
+        if haStage is not None:
+            haStage.put(payload)
+        return
+
+    route = topicRouter.route(topic)
+    if route is None:
+        return
+    metricMessagesReceived.inc(route.gw)
+    if debugTrace.enabled(route.gw, route.radioId):
+        debugTrace.log('receive', route.gw, route.radioId, topic=topic, payload=payload.decode('utf-8', 'replace'))
+
+    # payloads, RSSI, etc each have their own handler; whatever else the gateway sends is ignored
+    handler = TOPIC_HANDLERS.get(route.kind)
+    if handler is not None:
+        handler(route, topic, payload, recvTs)
+
+
+def _handle_payload(route, topic, payload, recvTs):
+    # parse received payload
+    start = time.monotonic()
+    measurements = _decode_payload(route, topic, payload.decode('utf-8'), recvTs)
+    metricDecodeSeconds.observe(time.monotonic() - start)
+
+    # hand the measurements over to the sinks
+    if measurements:
+        if debugTrace.enabled(route.gw, measurements[0].sensor):
+            debugTrace.log('decoded', route.gw, measurements[0].sensor, type=measurements[0].type,
+                           measurements={m.measurement: m.value for m in measurements})
+        _send_sensor_data(measurements)
+
+
+def _handle_rssi(route, topic, payload, recvTs):
+    # the signal strength the gateway received a node with, only written to InfluxDB
+    if not (influxDbEnabled and influxDbLogRssi):
+        return
+    try:
+        rssi = int(payload)
+    except ValueError:
+        myLog.error('Invalid RSSI received: %s - %s', topic, payload)
+        metricMessagesRejected.inc(route.gw, 'error')
+        return
+    influxWriter.put('%s value=%s %u' % (_influx_series_key('rssi', route.gw, route.radioId, None), _influx_field_value(rssi), int(recvTs * 1000000000)))
+
+
+# handler of each kind of gateway topic
+TOPIC_HANDLERS = {
+    'payload': _handle_payload,
+    'rssi': _handle_rssi,
+}
+
+
+def _handle_ha_status(payload):
+    global haReplay
+
+    # whatever a running replay is sending is out of date now
+    _cancel_ha_replay()
+
+    # if HA is coming online, then we need to re-publish all of the sensors
+    if payload.decode("utf-8")  == 'online':
+        myLog.info('HA is starting; send previous measurements')
+
+        # discovery configs first, so HA knows the entities by the time their state arrives
+        messages = [('ha_discovery', r.discoveryTopic, r.discoveryPayload, True) for r in sensorRegistry if r.provisioned]
+
+        # all measurements of a node share a state topic
+        for topic, records in sensorRegistry.byStateTopic.items():
+            messages.append(('ha_state', topic, {r.measurement: r.value for r in records}, False))
+
+        # the publishing happens in the background, so we can carry on with new measurements
+        haReplay = HaReplayThread(messages, haReplayChunkSize, haReplayChunkInterval)
+        haReplay.start()
     else:
-        # parse received payload
-        measurements = _parse_mqtt_message(msg.topic, msg.payload.decode('utf-8'))
-        myLog.debug('Parsed measurements:\n%s', pprint.pformat(measurements))
+        myLog.info('HA is stopping; no need to do anything')
+
+
+def _cancel_ha_replay():
+    if haReplay is not None and haReplay.is_alive():
+        haReplay.cancel()
+        metricHaReplayCancelled.inc()
+
+
+def _decode_payload(route, topic, payload, recvTs):
+    gwMac = route.gw
+    try:
+        # process payload
+        # first get the radio ID and the sensor type
+        raw = bytes.fromhex(payload)
+        radioId, sensType = PAYLOAD_HEADER.unpack_from(raw)
+
+        # process the rest of the payload based on sensor type
+        decoder = nodeDecoders.get(sensType)
+        if decoder is None:
+            # not sure what to do
+            myLog.error('Unknown sensor type received: %s - %s', topic, payload)
+            metricMessagesRejected.inc(gwMac, 'unknown_type')
+            return None
+
+        rMeas = [SensorData(gwMac, radioId, sensType, name, value, recvTs) for name, value in decoder.decode(raw)]
+        metricMessagesDecoded.inc(gwMac, sensType)
+        return rMeas
+    except:
+        # handle exceptions
+        myLog.error('Error while processing message: %s - %s', topic, payload)
+        metricMessagesRejected.inc(gwMac, 'error')
+
+
+def _ha_measurement_info(sensType, measurement):
+    # HA metadata of a measurement, looked up once from the node type definitions
+    key = (sensType, measurement)
+    info = haMeasurementCache.get(key)
+    if info is None:
+        decoder = nodeDecoders.get(sensType)
+        field = decoder.info.get(measurement) if decoder is not None else None
+        if field is None:
+            info = HaMeasurementInfo('sensor', 'None', 'None')
+        else:
+            info = HaMeasurementInfo(field.component, field.device_class or 'None', field.unit or 'None')
+        haMeasurementCache[key] = info
+    return info
 
-        # write the measurements into the database
-        if measurements is not None:
-            _send_sensor_data(measurements)
 
-def s16(value):
-    # turn hex number to signed integers
-    return -(value & 0x8000) | (value & 0x7fff)
+def _ha_state_topic(gw, sensor):
+    key = (gw, sensor)
+    topic = haStateTopicCache.get(key)
+    if topic is None:
+        topic = haStateTopicCache[key] = haBaseTopic + '/' + gw + '/' + str(sensor)
+    return topic
 
-def _parse_mqtt_message(topic, payload):
-    # this will store the return values
-    rMeas = []
 
-    match = re.match(mqttRegex, topic)
-    if match:
-        try:
-            gwMac = match.group(1)
-            # extract the MAC address (and strip out the colons)
-            macMatch = re.match('.*-(..:..:..:..:..:..)-.*', gwMac)
-            if macMatch:
-                gwMac = macMatch.group(1).replace(':', '')
-            radioId = match.group(2)
-            data = match.group(3)
-
-            if 'payload' not in data:
-                #print('Not payload')
-                return None
-
-            #print('+ GW MAC: ' + gwMac + '\n+ Radio ID: ' + radioId + '\n+ Payload: ' + data)
-
-            # process payload
-            # first get the radio ID
-            radioIdHex = payload[2:4] + payload[0:2]
-            radioId = int(radioIdHex, 16)
-
-            # get the sensor type
-            sensTypeHex = payload[4:6]
-            sensType = int(sensTypeHex, 16)
-
-            # process the rest of the payload based on sensor type
-            if (sensType == NODEFUNC_POWER_SINGLE):
-                powerHex = payload[8:10] + payload[6:8]
-                power = s16(int(powerHex, 16))
-                vrmsHex = payload[12:14] + payload[10:12]
-                vrms = int(vrmsHex, 16) / 10
-
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'power1', power))
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'vrms', vrms))
-
-                return rMeas
-            elif (sensType == NODEFUNC_POWER_DOUBLE):
-                powerHex = payload[8:10] + payload[6:8]
-                power = s16(int(powerHex, 16))
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'power1', power))
-
-                powerHex = payload[12:14] + payload[10:12]
-                power = s16(int(powerHex, 16))
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'power2', power))
-
-                vrmsHex = payload[16:18] + payload[14:16]
-                vrms = int(vrmsHex, 16) / 10
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'vrms', vrms))
-
-                return rMeas
-            elif (sensType == NODEFUNC_POWER_QUAD):
-                powerHex = payload[8:10] + payload[6:8]
-                power = s16(int(powerHex, 16))
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'power1', power))
-
-                powerHex = payload[12:14] + payload[10:12]
-                power = s16(int(powerHex, 16))
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'power2', power))
-
-                powerHex = payload[16:18] + payload[14:16]
-                power = s16(int(powerHex, 16))
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'power3', power))
-
-                powerHex = payload[20:22] + payload[18:20]
-                power = s16(int(powerHex, 16))
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'power4', power))
-
-                vrmsHex = payload[24:26] + payload[22:24]
-                vrms = int(vrmsHex, 16) / 10
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'vrms', vrms))
-
-                return rMeas
-            elif (sensType == NODEFUNC_TEMP_RH):
-                tempHex = payload[8:10] + payload[6:8]
-                temp = struct.unpack('>h', bytes.fromhex(tempHex))[0] / 100
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'temp', temp))
-
-                rhHex = payload[12:14] + payload[10:12]
-                rh = int(rhHex, 16) / 100
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'rh', rh))
-
-                rhHex = payload[16:18] + payload[14:16]
-                vbatt = int(rhHex, 16)
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'vbatt', vbatt))
-
-                return rMeas
-            elif (sensType == NODEFUNC_TEMP_PRESSURE):
-                tempHex = payload[8:10] + payload[6:8]
-                temp = struct.unpack('>h', bytes.fromhex(tempHex))[0] / 100
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'temp', temp))
-
-                rhHex = payload[16:18] + payload[14:16] + payload[12:14] + payload[10:12]
-                pressure = int(rhHex, 16) / 100
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'pressure', pressure))
-
-                rhHex = payload[16:18] + payload[14:16]
-                vbatt = int(rhHex, 16)
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'vbatt', vbatt))
-
-                return rMeas
-            elif (sensType == NODEFUNC_TRIGGER):
-                rhHex = payload[6:8]
-                trigger = int(rhHex, 16)
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'trigger', trigger))
-
-                rhHex = payload[10:12] + payload[8:10]
-                vbatt = int(rhHex, 16)
-                rMeas.append(SensorData(gwMac, radioId, sensType, 'vbatt', vbatt))
-
-                return rMeas
-            else:
-                # not sure what to do
-                myLog.error('Unknown sensor type received: %s - %s', topic, payload)
-                return None
-        except:
-            # handle exceptions
-            myLog.error('Error while processing message: %s - %s', topic, payload)
-    else:
-        #print('No match')
-        return None
+def _ha_availability_topic(gw, sensor):
+    return _ha_state_topic(gw, sensor) + '/availability'
+
+
+def _publish_node_availability(key, online):
+    gw, sensor = key
+    if not online:
+        myLog.info('Node %s/%s has gone quiet, marking it unavailable', gw, sensor)
+        metricNodesExpired.inc()
+    _publish('ha_availability', _ha_availability_topic(gw, sensor), 'online' if online else 'offline', 0, True)
+
 
+def build_discovery(sensor_data):
+    # returns the HA discovery (config) topic and payload for a measurement
+    info = _ha_measurement_info(sensor_data.type, sensor_data.measurement)
+    isBinary = info.component == 'binary_sensor'
 
-def get_device_class(sensor_data):
-    if sensor_data.measurement == 'power1' or sensor_data.measurement == 'power2' or sensor_data.measurement == 'power3' or sensor_data.measurement == 'power4':
-        return 'power'
-    if sensor_data.measurement == 'vrms':
-        return 'voltage'
-    if sensor_data.measurement == 'temp':
-        return 'temperature'
-    if sensor_data.measurement == 'rh':
-        return 'humidity'
-    if sensor_data.measurement == 'vbatt':
-        return 'voltage'
-    if sensor_data.measurement == 'pressure':
-        return 'pressure'
-    return 'None'
-
-
-def get_unit_of_measurement(sensor_data):
-    if sensor_data.measurement == 'power1' or sensor_data.measurement == 'power2' or sensor_data.measurement == 'power3' or sensor_data.measurement == 'power4':
-        return 'W'
-    if sensor_data.measurement == 'vrms':
-        return 'V'
-    if sensor_data.measurement == 'temp':
-        return '°C'
-    if sensor_data.measurement == 'rh':
-        return '%'
-    if sensor_data.measurement == 'vbatt':
-        return 'mV'
-    if sensor_data.measurement == 'pressure':
-        return 'mbar'
-    return 'None'
-
-
-def provision_sensor(sensor_data):
     json_body = {}
 
     json_body['availability'] = []
     json_body['availability'].append({})
     json_body['availability'][0]['topic'] = haBaseTopic + '/status'
+    if haAvailabilityMultiple:
+        # the entity is only available while both we and the node are
+        json_body['availability'].append({'topic': _ha_availability_topic(sensor_data.gw, sensor_data.sensor)})
+        json_body['availability_mode'] = 'all'
     json_body['device'] = {}
     json_body['device']['identifiers'] = []
     json_body['device']['identifiers'].append('rfm69gw_' + sensor_data.gw + '_' + str(sensor_data.sensor))
     json_body['device']['manufacturer'] = 'Owltronics'
     json_body['device']['model'] = 'Owlet sensor'
     json_body['device']['name'] = haBaseTopic + '_' + sensor_data.gw + '_' + str(sensor_data.sensor)
-    if (not sensor_data.measurement == 'trigger'):
-        json_body['device_class'] = get_device_class(sensor_data)
+    if not isBinary:
+        json_body['device_class'] = info.device_class
     json_body['enabled_by_default'] = True
     json_body['name'] = sensor_data.gw + '-' + str(sensor_data.sensor) + '-' + sensor_data.measurement
-    if (not sensor_data.measurement == 'trigger'):
+    if not isBinary:
         json_body['state_class'] = 'measurement'
-    json_body['state_topic'] = haBaseTopic + '/' + sensor_data.gw + '/' + str(sensor_data.sensor)
+    json_body['state_topic'] = _ha_state_topic(sensor_data.gw, sensor_data.sensor)
     json_body['unique_id'] = sensor_data.gw + '_' + str(sensor_data.sensor) + '_' + sensor_data.measurement
-    if (not sensor_data.measurement == 'trigger'):
-        json_body['unit_of_measurement'] = get_unit_of_measurement(sensor_data)
+    if not isBinary:
+        json_body['unit_of_measurement'] = info.unit
     else:
         json_body['payload_on'] = 1
         json_body['payload_off'] = 0
     json_body['value_template'] = '{{ value_json.' + sensor_data.measurement + ' }}'
 
-    if (not sensor_data.measurement == 'trigger'):
-        t = 'homeassistant/sensor/' + haBaseTopic + '-' + sensor_data.gw + '-' + str(sensor_data.sensor) + '/' + sensor_data.measurement + '/config'
-    else:
-        t = 'homeassistant/binary_sensor/' + haBaseTopic + '-' + sensor_data.gw + '-' + str(sensor_data.sensor) + '/' + sensor_data.measurement + '/config'
-    myLog.debug('Provisioning sensor in HA (%s):\n%s', t, json.dumps(json_body))
+    t = 'homeassistant/' + info.component + '/' + haBaseTopic + '-' + sensor_data.gw + '-' + str(sensor_data.sensor) + '/' + sensor_data.measurement + '/config'
 
-    # send the provisioning message - set the retain flag
-    mqtt_client.publish(t, json.dumps(json_body), 0, True)
+    return t, json.dumps(json_body)
 
 
-def _send_sensor_data(sensor_data):
-    # check if we need to write to InfluxDb
-    if influxDbEnabled:
-        # construct the JSON
-        json_body = []
-        for m in sensor_data:
-            json_body.append({ 'measurement': m.measurement, 'tags': { 'nodeid' : m.sensor }, 'fields' : { 'value' : m.value }})
+def provision_sensor(record):
+    myLog.debug('Provisioning sensor in HA (%s):\n%s', record.discoveryTopic, record.discoveryPayload)
 
-        myLog.debug('Writing JSON to DB:\n%s', pprint.pformat(json_body))
+    # send the provisioning message - set the retain flag. It only counts as provisioned once it's gone out,
+    # until then the record is provisioning (see _apply_provision_results)
+    payload = record.discoveryPayload
+    record.provisioned = False
+    if _publish('ha_discovery', record.discoveryTopic, payload, 0, True, lambda ok: haProvisionResults.append((record, payload, ok))):
+        record.provisioning = payload
 
-        try:
-            # write measurements to the database
-            influxClient.write_points(json_body)
-        except:
-            myLog.error("Exception while writing data to database")
 
-    # check if we need to rebroadcast the unpacked packet
-    if rebroadcastEnabled:
-        json_body = {}
-        # now iterate through the measurements
-        for m in sensor_data:
-            # add the key if it doesn't exist
-            if m.sensor not in json_body:
-                json_body[m.sensor] = {}
-            # now add the measurement and its value
-            json_body[m.sensor][m.measurement] = m.value
-
-        # now iterate through the transformed measurements and see what needs to be published
-        for m in json_body:
-            if m in rebroadcastSensors:
-                # log the event
-                myLog.debug('Rebroadcasting MQTT %s/%u/%s', rebroadcastTopic, m, pprint.pformat(json_body[m]))
-                # publish the message
-                mqtt_client.publish(rebroadcastTopic + '/' + str(m), json.dumps(json_body[m]))
-
-    # check if we need to send the data to HA
-    if haIntegrationEnabled:
-        # we'll collect all the measurements here, so we avoid sending multiple MQTT messages for multi-sensor devices
-        # format is data_json['state_topic']['measurement'] = value to send
-        data_json = {}
+def _apply_provision_results():
+    # runs on the HA worker; a failed or outdated discovery config is sent again with the next measurement
+    while haProvisionResults:
+        record, payload, ok = haProvisionResults.popleft()
+        if record.provisioning is not payload:
+            continue
+        record.provisioning = None
+        if ok and payload == record.discoveryPayload:
+            record.provisioned = True
+            metricHaProvisioned.inc()
 
-        # now iterate through the measurements
-        for m in sensor_data:
-            # flag to mark if we need to provision the sensor to HA
-            provisionSensor = True
 
-            try:
-                if provisionedSensors[m.gw]:
-                    try:
-                        if provisionedSensors[m.gw][m.sensor]:
-                            try:
-                                if provisionedSensors[m.gw][m.sensor][m.measurement]:
-                                    provisionSensor = False
-                            except KeyError:
-                                # add the measurement key
-                                provisionedSensors[m.gw][m.sensor][m.measurement] = {}
-                                provisionedSensors[m.gw][m.sensor][m.measurement]['status'] = 1
-                                provisionedSensors[m.gw][m.sensor][m.measurement]['value'] = m.value
-                    except KeyError:
-                        # add the sensor & measurement key
-                        provisionedSensors[m.gw][m.sensor] = {}
-                        provisionedSensors[m.gw][m.sensor][m.measurement] = {}
-                        provisionedSensors[m.gw][m.sensor][m.measurement]['status'] = 1
-                        provisionedSensors[m.gw][m.sensor][m.measurement]['value'] = m.value
-            except KeyError:
-                # add the GW, sensor & measurement key
-                provisionedSensors[m.gw] = {}
-                provisionedSensors[m.gw][m.sensor] = {}
-                provisionedSensors[m.gw][m.sensor][m.measurement] = {}
-                provisionedSensors[m.gw][m.sensor][m.measurement]['status'] = 1
-                provisionedSensors[m.gw][m.sensor][m.measurement]['value'] = m.value
-            
-            if provisionSensor:
-                # let's provision the sensor
-                myLog.debug("Couldn't find sensor with parameters %s, %s, %s", m.gw, m.sensor, m.measurement)
-                provision_sensor(m)
-            
-            try:
-                data_json[haBaseTopic + '/' + m.gw + '/' + str(m.sensor)][m.measurement] = m.value
-            except KeyError:
-                # looks like we're missing the base key
-                data_json[haBaseTopic + '/' + m.gw + '/' + str(m.sensor)] = {}
-                data_json[haBaseTopic + '/' + m.gw + '/' + str(m.sensor)][m.measurement] = m.value
+def _refresh_ha_discovery():
+    # the node types have been reloaded: forget the cached metadata and re-provision whatever looks different now
+    haMeasurementCache.clear()
+    haStateTopicCache.clear()
+
+    for record in sensorRegistry:
+        topic, payload = build_discovery(record)
+        if topic == record.discoveryTopic and payload == record.discoveryPayload:
+            continue
+
+        # one that's still on its way counts as provisioned here
+        sent = record.provisioned or record.provisioning is not None
+        if sent and topic != record.discoveryTopic:
+            # the component has changed, remove the old entity from HA
+            _publish('ha_discovery', record.discoveryTopic, '', 0, True)
+
+        record.discoveryTopic = topic
+        record.discoveryPayload = payload
+        if sent:
+            provision_sensor(record)
+
+
+def _send_sensor_data(sensor_data):
+    # check if we need to write to InfluxDb
+    if influxDbEnabled and influxDbWriteMode != 'aggregate':
+        # format the line protocol here and hand it over to the writer thread
+        for m in sensor_data:
+            line = _influx_series_key(m.measurement, m.gw, m.sensor, m.type) + ' value=' + _influx_field_value(m.value)
+            if m.ts is not None:
+                line += ' %u' % int(m.ts * 1000000000)
+            influxWriter.put(line)
+
+    # downsampled data has its own worker
+    if aggregateStage is not None:
+        aggregateStage.put(sensor_data)
+
+    # the MQTT based sinks have their own workers
+    if rebroadcastStage is not None:
+        rebroadcastStage.put(sensor_data)
+    if haStage is not None:
+        haStage.put(sensor_data)
+
+
+def _aggregate_sink(item):
+    # flushes arrive as a function, everything else is a list of measurements
+    if callable(item):
+        item()
+    else:
+        for m in item:
+            aggregator.add(m)
+
+
+def _write_aggregate(key, acc):
+    gw, sensor, sensType, measurement = key
+    influxWriter.put('%s min=%s,max=%s,mean=%s,last=%s,count=%ui %u' % (
+        _influx_series_key(measurement + influxDbAggregateSuffix, gw, sensor, sensType),
+        _influx_field_value(acc.min), _influx_field_value(acc.max), _influx_field_value(acc.total / acc.count),
+        _influx_field_value(acc.last), acc.count, int(acc.start * 1000000000)))
+
+
+def _influx_escape_tag(value):
+    return str(value).replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def _influx_series_key(measurement, gw, sensor, sensType):
+    # the escaped 'measurement,tags' prefix of a line, tags in key order as InfluxDB prefers
+    key = (measurement, gw, sensor, sensType)
+    seriesKey = influxSeriesKeys.get(key)
+    if seriesKey is None:
+        seriesKey = '%s,gw=%s,nodeid=%s' % (measurement.replace(',', '\\,').replace(' ', '\\ '), _influx_escape_tag(gw), _influx_escape_tag(sensor))
+        # measurements that don't come from a payload (RSSI) have no sensor type
+        if sensType is not None:
+            seriesKey += ',type=' + _influx_escape_tag(sensType)
+        influxSeriesKeys[key] = seriesKey
+    return seriesKey
+
+
+def _influx_field_value(value):
+    # same field types the influxdb client used: integers get the i suffix, bools are true/false
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '%di' % value
+    return repr(float(value))
+
+
+def _ha_sink(item):
+    # status messages from HA arrive as the raw payload, jobs that need the registry as a function,
+    # everything else is a list of measurements
+    _apply_provision_results()
+    if isinstance(item, bytes):
+        _handle_ha_status(item)
+    elif callable(item):
+        item()
+    else:
+        _send_ha_state(item)
+
+    # snapshot the registry every now and then
+    if haStateFile and time.monotonic() - sensorRegistry.lastSaved >= haSnapshotInterval:
+        _save_registry()
+
+
+def _save_registry():
+    try:
+        sensorRegistry.save(haStateFile)
+        myLog.debug('Saved %u measurements to %s', len(sensorRegistry), haStateFile)
+    except (OSError, TypeError, ValueError) as e:
+        myLog.error('Unable to save sensor state to %s: %s', haStateFile, e)
+        # don't retry on every message
+        sensorRegistry.lastSaved = time.monotonic()
+
+
+def _load_registry():
+    if not os.path.exists(haStateFile):
+        myLog.info('No saved sensor state at %s', haStateFile)
+        return
+
+    try:
+        changed = sensorRegistry.load(haStateFile)
+        myLog.info('Loaded %u measurements from %s (%u need to be provisioned again)', len(sensorRegistry), haStateFile, changed)
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        # start from scratch rather than with a half loaded registry
+        myLog.error('Unable to load sensor state from %s: %s', haStateFile, e)
+        sensorRegistry.__init__()
+
+
+def _rebroadcast_sensor_data(item):
+    # jobs arrive as a function, everything else is a list of measurements (of one node)
+    if callable(item):
+        item()
+        return
+
+    first = item[0]
+    targets = rebroadcastRouter.route(first.gw, first.sensor, first.type)
+
+    # rules publishing the same measurements share the payload
+    payloads = {}
+    for topic, measurements, qos, retain in targets:
+        if measurements not in payloads:
+            values = {m.measurement: m.value for m in item if measurements is None or m.measurement in measurements}
+            payloads[measurements] = json.dumps(values) if values else None
+        payload = payloads[measurements]
+        if payload is None:
+            continue
+
+        # log the event
+        if debugTrace.enabled(first.gw, first.sensor):
+            debugTrace.log('rebroadcast', first.gw, first.sensor, topic=topic, payload=payload)
+        # publish the message
+        _publish('rebroadcast', topic, payload, qos, retain)
+
+
+def _send_ha_state(sensor_data):
+    # a payload is from one node; its availability goes out before any of its state
+    if nodeTracker is not None and sensor_data:
+        nodeTracker.seen((sensor_data[0].gw, sensor_data[0].sensor))
+
+    # now iterate through the measurements
+    for m in sensor_data:
+        record = sensorRegistry.get((m.gw, m.sensor, m.measurement))
+        if record is None:
+            myLog.debug("Couldn't find sensor with parameters %s, %s, %s", m.gw, m.sensor, m.measurement)
+            record = sensorRegistry.add(m)
+
+        # keep the last value, so we can replay it when HA restarts
+        record.value = m.value
+        record.lastSeen = m.ts
+
+        if not record.provisioned and record.provisioning is None:
+            # let's provision the sensor
+            provision_sensor(record)
+
+        # we collect the measurements per state topic, so we avoid sending multiple MQTT messages for multi-sensor devices
+        haPublisher.update(record.stateTopic, m.measurement, m.value)
+
+    # without a publish window, send the measurements right away; otherwise haFlushTimer takes care of it
+    if not haPublishWindow:
+        haPublisher.flush()
 
-        # we're ready to send the measurements as all the sensors have been provisioned
-        myLog.debug('Sending measurements to HA:\n%s', json.dumps(data_json))
-        for k in data_json:
-            mqtt_client.publish(k, json.dumps(data_json[k]))
 
 def _init_influxdb_database():
     initialised = False
 
     while not initialised:
         try:
-            databases = influxClient.get_list_database()
             # create database if it doesn't exist
-            if len(list(filter(lambda x: x['name'] == influxDbDatabase, databases))) == 0:
-                myLog.warning("Database doesn't exists - will create it")
-                influxClient.create_database(influxDbDatabase)
-
-            # switch database
-            influxClient.switch_database(influxDbDatabase)
+            influxClient.create_database()
             myLog.info('Database selected')
             initialised = True
         except:
@@ -518,56 +3092,593 @@ def _init_influxdb_database():
             time.sleep(5)
 
 
+def _new_mqtt_client():
+    client = mqtt.Client(mqttClientId)
+    client.username_pw_set(mqttUser, mqttPassword)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    return client
+
+
+def _init_mqtt_publisher():
+    global mqttPublisher
+
+    client = mqtt.Client(mqttClientId + '-pub')
+    client.username_pw_set(mqttUser, mqttPassword)
+    client.on_connect = on_publisher_connect
+    if haIntegrationEnabled and _owns_ha_status():
+        # this is the connection HA status goes out on, so the broker can tell HA when we vanish
+        client.will_set(haBaseTopic + '/status', 'offline', 0, True)
+    mqttPublisher = MqttPublisher(client, mqttPublishMaxInflight, mqttPublishQueueSize, mqttPublishRetries)
+    mqttPublisher.start()
+
+    # paho connects (and reconnects) in its own network thread
+    client.connect_async(mqttAddress, mqttPort)
+    client.loop_start()
+
+
 def _init_mqtt():
     initialised = False
 
     global mqtt_client
-    mqtt_client = mqtt.Client(mqttClientId)
-    mqtt_client.username_pw_set(mqttUser, mqttPassword)
-    mqtt_client.on_connect = on_connect
-    mqtt_client.on_message = on_message
+    mqtt_client = _new_mqtt_client()
 
     # open MQTT connection and start listening to messages
-    while not initialised:
+    while not initialised and not stopRequested:
         try:
             mqtt_client.connect(mqttAddress, mqttPort)
-            # need to call loop as we need to process the connect response
-            mqtt_client.loop()
             initialised = True
         except:
             myLog.error("Unable to connect to MQTT, retrying in 5 seconds")
             time.sleep(5)
 
-    # enter network loop
-    mqtt_client.loop_forever()
+    # the network loop runs on a thread of its own, so the main thread is free for the signal handlers
+    mqtt_client.loop_start()
+
+
+def _init_pipeline():
+    global decodeStages
+    global rebroadcastStage
+    global rebroadcastRouter
+    global haStage
+    global aggregateStage
+    global aggregator
+    global aggregateTimer
+    global sensorRegistry
+    global haPublisher
+    global haFlushTimer
+    global duplicateFilter
+    global nodeTracker
+    global nodeTimer
+
+    if pipelineDedupWindow > 0:
+        duplicateFilter = DuplicateFilter(pipelineDedupWindow)
+
+    # the asyncio runtime runs the stages as tasks on the event loop
+    stageClass = AsyncPipelineStage if pipelineRuntime == 'asyncio' else PipelineStage
+
+    decodeStages = [stageClass('decode-' + str(i), _decode_message, pipelineQueueSize) for i in range(pipelineDecodeWorkers)]
+    if influxDbEnabled and influxDbWriteMode != 'raw':
+        aggregateStage = stageClass('aggregate', _aggregate_sink, pipelineQueueSize)
+        aggregator = Aggregator(influxDbAggregateWindows, _write_aggregate)
+        # finished windows are flushed on the aggregate worker
+        aggregateTimer = PeriodicThread('AggregateTimer', 1.0, lambda: aggregateStage.put(aggregator.flush))
+    if rebroadcastEnabled:
+        rebroadcastStage = stageClass('rebroadcast', _rebroadcast_sensor_data, pipelineQueueSize)
+        rebroadcastRouter = RebroadcastRouter(rebroadcastRules)
+    if haIntegrationEnabled:
+        sensorRegistry = SensorRegistry()
+        # pick up where we left off, so we don't re-provision everything in HA
+        if haStateFile:
+            _load_registry()
+        haStage = stageClass('homeassistant', _ha_sink, pipelineQueueSize)
+        haPublisher = HaStatePublisher(haDeadbands, haHeartbeat)
+        if haPublishWindow:
+            # the flush runs on the HA worker, like everything else touching HA state
+            haFlushTimer = PeriodicThread('HaFlushTimer', haPublishWindow, lambda: haStage.put(haPublisher.flush))
+        if haAvailabilityMultiple:
+            nodeTracker = NodeTracker(haAvailabilityMultiple, haAvailabilityMinTimeout, haAvailabilityMaxTimeout, _publish_node_availability)
+            # the nodes we knew about before the restart are online in HA, give them a chance to check in
+            for records in sensorRegistry.byStateTopic.values():
+                nodeTracker.add((records[0].gw, records[0].sensor), restored=True)
+            # like the flush, expiring runs on the HA worker
+            nodeTimer = PeriodicThread('NodeTimer', 1.0, lambda: haStage.put(nodeTracker.expire))
+
+    for stage in _pipeline_stages():
+        stage.start()
+    if haFlushTimer is not None:
+        haFlushTimer.start()
+    if nodeTimer is not None:
+        nodeTimer.start()
+    if aggregateTimer is not None:
+        aggregateTimer.start()
+
+
+def _shutdown_pipeline():
+    if haFlushTimer is not None:
+        haFlushTimer.shutdown()
+    if nodeTimer is not None:
+        nodeTimer.shutdown()
+    if aggregateTimer is not None:
+        aggregateTimer.shutdown()
+    _cancel_ha_replay()
+
+    # finish off whatever is still in the pipeline
+    for stage in _pipeline_stages():
+        stage.shutdown()
+
+    # write out the windows we've started
+    if aggregator is not None:
+        aggregator.flush(True)
+
+    # the HA worker has stopped, so it's safe to touch HA state from here
+    if haPublisher is not None:
+        haPublisher.flush()
+    if sensorRegistry is not None and haStateFile:
+        _apply_provision_results()
+        _save_registry()
+
+
+def _pipeline_stages():
+    # every pipeline worker, the ones feeding others first (that's the order to stop them in)
+    stages = list(decodeStages)
+    if aggregateStage is not None:
+        stages.append(aggregateStage)
+    if rebroadcastStage is not None:
+        stages.append(rebroadcastStage)
+    if haStage is not None:
+        stages.append(haStage)
+    return stages
+
+
+def _init_sinks():
+    # init InfluxDb (if enabled)
+    if influxDbEnabled:
+        # with a spool, points are kept on disk until InfluxDB is up, so there's no need to wait for it
+        spool = None
+        if influxDbSpoolDirectory:
+            spool = InfluxSpool(influxDbSpoolDirectory, influxDbSpoolSegmentSize, influxDbSpoolMaxSize)
+        else:
+            _init_influxdb_database()
+
+        # start the batched writer
+        global influxWriter
+        influxWriter = InfluxWriterThread(influxClient, influxDbBatchSize, influxDbFlushInterval, influxDbQueueSize, influxDbDropPolicy,
+                                          spool, influxDbRetryInterval, influxDbBackfillRate)
+        influxWriter.start()
+
+    # start the traffic recorder
+    if captureEnabled:
+        global captureWriter
+        captureWriter = CaptureWriterThread(captureDirectory, captureMaxSize, captureRotateInterval, captureKeep, captureQueueSize)
+        captureWriter.start()
+
+    # and the MQTT publisher, if there's anything to publish
+    if haIntegrationEnabled or rebroadcastEnabled:
+        _init_mqtt_publisher()
+
+
+def _shutdown_sinks():
+    # flush whatever is still waiting for the database
+    if influxWriter is not None:
+        influxWriter.shutdown()
+
+    # close the capture file
+    if captureWriter is not None:
+        captureWriter.shutdown()
+
+    # and send out whatever we've still got to publish
+    if mqttPublisher is not None:
+        mqttPublisher.shutdown()
 
 
 def main():
-    # init InfluxDb (if enabled)
-    if influxDbEnabled:
-        _init_influxdb_database()
+    _init_sinks()
+
+    # start the pipeline workers
+    _init_pipeline()
 
     # init MQTT
     _init_mqtt()
 
+    # wait for INT or TERM
+    while not stopRequested:
+        time.sleep(0.5)
 
-def signal_handler(sig, frame):
     myLog.info("Stopping gracefully")
 
+    # stop taking in messages
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
+
+    # finish off whatever is still in the pipeline
+    _shutdown_pipeline()
+
     # if HA integration is enabled, we need to send a last will message
-    if haIntegrationEnabled:
-        mqtt_client.publish(haBaseTopic + '/status', 'offline', 0, True)
+    if haIntegrationEnabled and _owns_ha_status():
+        _publish('ha_status', haBaseTopic + '/status', 'offline', 0, True)
         myLog.debug('Sending last will message to HA')
 
-    # stop MQTT loop
-    mqtt_client.loop_stop()
+    _shutdown_sinks()
 
     # stop our API server
-    global server
     server.shutdown()
 
-    # finally exit
-    sys.exit(0)
+
+def signal_handler(sig, frame):
+    # only ask main() to stop: the handler runs on the main thread, which may be in the middle of something
+    # holding a lock the shutdown needs
+    global stopRequested
+    stopRequested = True
+
+
+async def main_async():
+    # the asyncio runtime: MQTT, the pipeline and the API server are tasks on one event loop; the InfluxDB writer,
+    # the capture writer and the timers keep their threads and hand their work over to the loop
+    loop = asyncio.get_running_loop()
+    stopEvent = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stopEvent.set)
+    loop.add_signal_handler(signal.SIGTERM, stopEvent.set)
+    loop.add_signal_handler(signal.SIGUSR1, reload_handler, signal.SIGUSR1, None)
+
+    # waiting for InfluxDB blocks, so do it off the loop
+    await loop.run_in_executor(None, _init_sinks)
+    _init_pipeline()
+
+    global mqtt_client
+    mqtt_client = _new_mqtt_client()
+    mqttLoop = AsyncMqttLoop(loop, mqtt_client)
+    mqttTask = loop.create_task(mqttLoop.run())
+    myLog.info('Starting API server on %s port %u', apiAddress, apiPort)
+    apiServer = await asyncio.start_server(_serve_api_request, host=apiAddress, port=apiPort)
+
+    await stopEvent.wait()
+    myLog.info("Stopping gracefully")
+
+    # stop taking in messages, then finish off whatever is still in the pipeline (the stages keep running
+    # on the loop while we wait for them)
+    mqttLoop.pause()
+    await loop.run_in_executor(None, _shutdown_pipeline)
+
+    # if HA integration is enabled, we need to send a last will message
+    if haIntegrationEnabled and _owns_ha_status():
+        _publish('ha_status', haBaseTopic + '/status', 'offline', 0, True)
+        myLog.debug('Sending last will message to HA')
+
+    await loop.run_in_executor(None, _shutdown_sinks)
+    await mqttLoop.stop()
+    mqttTask.cancel()
+    await asyncio.gather(mqttTask, return_exceptions=True)
+    apiServer.close()
+    await apiServer.wait_closed()
+
+
+def _apply_shard(index):
+    # we're worker index of the supervisor: everything a worker owns on its own gets a name of its own
+    global shardIndex
+    global apiAddress
+    global apiPort
+    global mqttClientId
+    global haStateFile
+    global influxDbSpoolDirectory
+    global captureDirectory
+
+    shardIndex = index
+    # only the supervisor asks the workers, whatever address it listens on itself
+    apiAddress = '127.0.0.1'
+    apiPort = _shard_api_port(index)
+    mqttClientId = mqttClientId + '-' + str(index)
+    if haStateFile:
+        root, ext = os.path.splitext(haStateFile)
+        haStateFile = root + '.' + str(index) + ext
+    if influxDbSpoolDirectory:
+        influxDbSpoolDirectory = os.path.join(influxDbSpoolDirectory, 'shard-' + str(index))
+    captureDirectory = os.path.join(captureDirectory, 'shard-' + str(index))
+    myLog.info('Running as worker %u of %u', index, pipelineProcesses)
+
+
+def supervise(confFile):
+    # start a worker process per shard, restart them when they die, and serve their combined status on our API port
+    argv = [sys.executable, os.path.abspath(__file__)]
+    if confFile:
+        argv += ['-c', confFile]
+    for i in range(pipelineProcesses):
+        shardWorkers.append(ShardProcess(i, argv + ['--shard', str(i)], 5))
+
+    stopEvent = threading.Event()
+    signal.signal(signal.SIGINT, lambda sig, frame: stopEvent.set())
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopEvent.set())
+    def forward_reload(sig, frame):
+        # the workers reload their own node types
+        for worker in shardWorkers:
+            worker.signal(sig)
+    signal.signal(signal.SIGUSR1, forward_reload)
+
+    for worker in shardWorkers:
+        worker.start()
+    server = ServerThread(_supervisor_response)
+    server.start()
+
+    while not stopEvent.wait(1.0):
+        for worker in shardWorkers:
+            worker.check()
+
+    myLog.info("Stopping workers")
+    for worker in shardWorkers:
+        worker.signal(signal.SIGTERM)
+    for worker in shardWorkers:
+        if worker.proc is not None:
+            worker.wait(30)
+    server.shutdown()
+
+
+def reload_handler(sig, frame):
+    global nodeDecoders
+    global debugTrace
+
+    # nothing may escape from here, it would land in whatever the main thread was doing
+    myLog.info('Reloading node types and debug filters from the config file')
+    try:
+        config = _load_config_file(configFile)
+    except configparser.Error as e:
+        myLog.error('Unable to read the config file, keeping the current configuration: %s', e)
+        return
+
+    try:
+        debugTrace = _read_debug_trace(config)
+    except (ValueError, TypeError, configparser.Error) as e:
+        myLog.error('Invalid debug filters, keeping the current ones: %s', e)
+
+    try:
+        decoders = _compile_node_decoders(_read_node_layouts(config))
+    except (ValueError, TypeError) as e:
+        myLog.error('Invalid node type configuration, keeping the current one: %s', e)
+        return
+
+    # swap in the new table with a single assignment, so every message is decoded with either the old or the new one
+    nodeDecoders = decoders
+    myLog.info('Loaded %u node types', len(nodeDecoders))
+
+    # HA discovery payloads depend on the node types; the registry belongs to the HA worker, so let it do the update
+    if haStage is not None:
+        haStage.put(_refresh_ha_discovery)
+    # and so do rebroadcast topics with the node type name in them
+    if rebroadcastStage is not None:
+        rebroadcastStage.put(rebroadcastRouter.clear)
+
+
+class StubMqttClient:
+    """ Stands in for the MQTT client when replaying, only counts what would have been published """
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+
+class StubInfluxClient:
+    """ Stands in for the InfluxDB client when replaying, only counts the points and bytes written """
+
+    def __init__(self):
+        self.points = 0
+        self.bytes = 0
+
+    def create_database(self):
+        pass
+
+    def write(self, lines):
+        self.points += len(lines)
+        self.bytes += sum(len(line) + 1 for line in lines)
+
+
+def _backfill_groups(groups, counts):
+    # decode and write out what's been collected, a node type at a time
+    for sensType, (gws, timestamps, rows) in groups.items():
+        radioIds, values = nodeDecoders[sensType].decode_batch(rows)
+        counts['decoded'] += len(rows)
+        for name, column in values.items():
+            for gw, radioId, ts, value in zip(gws, radioIds, timestamps, column):
+                if influxDbWriteMode != 'aggregate':
+                    influxWriter.put('%s value=%s %u' % (_influx_series_key(name, gw, radioId, sensType), _influx_field_value(value), int(ts * 1000000000)))
+                if aggregator is not None:
+                    aggregator.add(SensorData(gw, radioId, sensType, name, value, ts))
+            counts['points'] += len(column)
+
+
+def backfill(fileNames, batchSize):
+    # re-decode recorded traffic with the current node types and write it to InfluxDB, with the recorded timestamps
+    # (which overwrites the points written when it was received). Rows are grouped by node type and decoded in
+    # chunks of BACKFILL_CHUNK, so memory use doesn't depend on how much is backfilled
+    global influxWriter
+    global aggregator
+    global numpy
+
+    try:
+        import numpy
+    except ImportError:
+        myLog.warning('NumPy is not installed, payloads are decoded one at a time')
+
+    client = InfluxLineClient(influxDbAddress, influxDbPort, influxDbUser, influxDbPassword, influxDbDatabase, influxDbGzipLevel, influxDbTimeout)
+    # large batches, and wait for the writer rather than dropping anything
+    influxWriter = InfluxWriterThread(client, batchSize, influxDbFlushInterval, influxDbQueueSize, 'block')
+    influxWriter.start()
+    if influxDbWriteMode != 'raw':
+        aggregator = Aggregator(influxDbAggregateWindows, _write_aggregate)
+    dedup = DuplicateFilter(pipelineDedupWindow) if pipelineDedupWindow > 0 else None
+
+    counts = collections.Counter()
+    # sensor type -> ([gw], [timestamp], [payload])
+    groups = {}
+    pending = 0
+    start = time.monotonic()
+    for fileName in fileNames:
+        myLog.info('Backfilling %s', fileName)
+        for ts, topic, payload in read_capture_file(fileName):
+            counts['messages'] += 1
+            route = topicRouter.route(topic)
+            if route is None or route.kind != 'payload':
+                continue
+            if dedup is not None and not dedup.first(payload, ts):
+                counts['duplicates'] += 1
+                continue
+
+            try:
+                raw = bytes.fromhex(payload.decode('utf-8'))
+            except ValueError:
+                raw = b''
+            decoder = nodeDecoders.get(raw[2]) if len(raw) >= PAYLOAD_HEADER.size else None
+            if decoder is None or len(raw) < decoder.size:
+                counts['rejected'] += 1
+                continue
+
+            group = groups.get(decoder.sensType)
+            if group is None:
+                group = groups[decoder.sensType] = ([], [], [])
+            group[0].append(route.gw)
+            group[1].append(ts)
+            group[2].append(raw[:decoder.size])
+            pending += 1
+            if pending >= BACKFILL_CHUNK:
+                _backfill_groups(groups, counts)
+                groups = {}
+                pending = 0
+                myLog.info('%u messages, %u points so far', counts['messages'], counts['points'])
+
+    _backfill_groups(groups, counts)
+    if aggregator is not None:
+        aggregator.flush(True)
+    influxWriter.shutdown()
+    elapsed = time.monotonic() - start
+
+    stats = influxWriter.stats()
+    print('Read %u messages in %.3f s (%.0f msg/s): %u decoded, %u rejected, %u duplicates' % (counts['messages'], elapsed,
+          counts['messages'] / elapsed if elapsed else 0.0, counts['decoded'], counts['rejected'], counts['duplicates']))
+    print('Wrote %u of %u points in %u batches (%u failed)' % (stats['written'], stats['queued'], stats['batches'], stats['errors']))
+
+
+# payloads decoded in one go by the backfill
+BACKFILL_CHUNK = 100000
+
+
+def read_capture_file(fileName):
+    # recorded traffic has one tab separated line per message: receive timestamp, topic, payload
+    # the file may be gzip compressed
+    opener = gzip.open if fileName.endswith('.gz') else open
+    with opener(fileName, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            ts, topic, payload = line.split('\t', 2)
+            yield float(ts), topic, payload.encode('utf-8')
+
+
+class LatencyHistogram:
+    """ Latencies for the replay report, counted in fixed buckets so memory doesn't grow with the capture
+
+    Bucket i holds latencies up to MIN * GROWTH ** i seconds, so a percentile is off by at most GROWTH - 1 (4%).
+    Only used from the thread it belongs to, and read once that has stopped.
+    """
+
+    MIN = 1e-6
+    GROWTH = 1.04
+    # 1 us to about 100 s, anything longer goes in the last bucket
+    COUNT = 470
+
+    def __init__(self):
+        self.counts = [0] * self.COUNT
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0 if value <= self.MIN else min(self.COUNT - 1, math.ceil(math.log(value / self.MIN, self.GROWTH)))
+        self.counts[i] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentiles(self, points=(50, 90, 99)):
+        result = []
+        for p in points:
+            if not self.count:
+                result.append(0.0)
+                continue
+            rank = min(self.count - 1, self.count * p // 100)
+            seen = 0
+            for i, c in enumerate(self.counts):
+                seen += c
+                if seen > rank:
+                    break
+            result.append(self.max if i == self.COUNT - 1 else min(self.max, self.MIN * self.GROWTH ** i))
+        return result
+
+
+def replay(fileNames, speed):
+    # push recorded traffic through the whole decode -> sink path, with stub sinks instead of MQTT and InfluxDB
+    # speed is a multiple of real time; 0 replays as fast as we can
+    global mqtt_client
+    global influxWriter
+    global influxDbEnabled
+    global rebroadcastEnabled
+    global haIntegrationEnabled
+    global haStateFile
+    global pipelineRuntime
+
+    # the replay feeds the stages from this thread, outside an event loop
+    pipelineRuntime = 'threads'
+    influxDbEnabled = True
+    rebroadcastEnabled = True
+    haIntegrationEnabled = True
+    # nothing reaches HA, so don't touch the daemon's snapshot (it would say the replayed sensors are provisioned)
+    haStateFile = ''
+
+    mqtt_client = StubMqttClient()
+    stubInflux = StubInfluxClient()
+    influxWriter = InfluxWriterThread(stubInflux, influxDbBatchSize, influxDbFlushInterval, influxDbQueueSize, influxDbDropPolicy)
+    influxWriter.latencies = LatencyHistogram()
+    influxWriter.start()
+    _init_pipeline()
+    for stage in _pipeline_stages():
+        stage.latencies = LatencyHistogram()
+
+    count = 0
+    firstTs = None
+    start = time.monotonic()
+    for fileName in fileNames:
+        myLog.info('Replaying %s', fileName)
+        for ts, topic, payload in read_capture_file(fileName):
+            if speed > 0:
+                if firstTs is None:
+                    firstTs = ts
+                delay = (ts - firstTs) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            # same dispatch as on_message, but wait for room instead of dropping
+            if _is_duplicate(topic, payload, ts):
+                continue
+            decodeStages[hash(topic) % len(decodeStages)].put((topic, payload, ts), True)
+            count += 1
+
+    # wait for everything to make it through the sinks
+    _shutdown_pipeline()
+    influxWriter.shutdown()
+    elapsed = time.monotonic() - start
+
+    print('Replayed %u messages in %.3f s (%.0f msg/s)' % (count, elapsed, count / elapsed if elapsed else 0.0))
+    print('%-16s %10s %8s %9s %9s %9s %9s' % ('stage', 'processed', 'dropped', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for stage in _pipeline_stages():
+        p50, p90, p99 = stage.latencies.percentiles()
+        print('%-16s %10u %8u %9.3f %9.3f %9.3f %9.3f' % (stage.name, stage.processed, stage.dropped, p50 * 1000, p90 * 1000, p99 * 1000, stage.latencies.max * 1000))
+    p50, p90, p99 = influxWriter.latencies.percentiles()
+    print('%-16s %10u %8u %9.3f %9.3f %9.3f %9.3f' % ('influxdb', influxWriter.batches, influxWriter.dropped, p50 * 1000, p90 * 1000, p99 * 1000, influxWriter.maxFlushLatency * 1000))
+    print('Published %u MQTT messages, wrote %u points (%u bytes of line protocol) in %u batches' % (mqtt_client.published, stubInflux.points, stubInflux.bytes, influxWriter.batches))
+
+    # ru_maxrss is in kilobytes on Linux
+    import resource
+    print('Peak memory: %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
 
 
 if __name__ == '__main__':
@@ -575,6 +3686,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--default", help="dump default config to stdout", action="store_true")
     parser.add_argument("-c", "--config", help="override default configuration file")
+    parser.add_argument("-r", "--replay", help="replay recorded traffic through stub sinks and report throughput", nargs='+', metavar='FILE')
+    parser.add_argument("--speed", help="replay speed as a multiple of real time (default: 0, as fast as possible)", type=float, default=0)
+    parser.add_argument("-b", "--backfill", help="re-decode recorded traffic and write it to InfluxDB with the recorded timestamps", nargs='+', metavar='FILE')
+    parser.add_argument("--batch-size", help="points per InfluxDB write when backfilling (default: 10000)", type=int, default=10000)
+    parser.add_argument("--shard", help=argparse.SUPPRESS, type=int)
     args = parser.parse_args()
 
     # check if we need to dump the config file
@@ -596,26 +3712,48 @@ if __name__ == '__main__':
     # read the config file
     readConfig(args.config)
 
-    # set loglevel
+    # set loglevel and format
     myLog.setLevel(logging.getLevelName(logLevel))
+    if logFormat == 'json':
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(JsonLogFormatter())
 
-    # disable Flask logging
-    apiServerLog = logging.getLogger('werkzeug')
-    apiServerLog.setLevel(logging.ERROR)
-    app.logger.disabled = True
-    apiServerLog.disabled = True
+    # offline replay doesn't need any of the servers or connections
+    if args.replay:
+        replay(args.replay, args.speed)
+        exit()
+    if args.backfill:
+        backfill(args.backfill, args.batch_size)
+        exit()
 
-    # start our API server
-    global server
-    server = ServerThread(app)
-    server.start()
+    # with more than one process, this one only looks after the workers
+    if pipelineProcesses > 1:
+        if args.shard is None:
+            supervise(args.config)
+            exit()
+        _apply_shard(args.shard)
 
     if influxDbEnabled:
         # open the InfluxDB connection
-        influxClient = InfluxDBClient(influxDbAddress, influxDbPort, influxDbUser, influxDbPassword, None)
+        influxClient = InfluxLineClient(influxDbAddress, influxDbPort, influxDbUser, influxDbPassword, influxDbDatabase, influxDbGzipLevel, influxDbTimeout)
+
+    # the asyncio runtime has its own API server and signal handling
+    if pipelineRuntime == 'asyncio':
+        # a module global, for the asyncio stages and loops
+        import asyncio
+        asyncio.run(main_async())
+        exit()
+
+    # start our API server
+    global server
+    server = ServerThread(_api_response)
+    server.start()
 
     # add INT and TERM handlers
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
+    # USR1 reloads the node types
+    signal.signal(signal.SIGUSR1, reload_handler)
+
     main()
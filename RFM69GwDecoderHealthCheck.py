@@ -3,22 +3,29 @@
 # -*- coding: latin-1 -*-
 
 """ RFM69Gw Decoder Healthcheck 
-This script checks the health of the RFM69GwDecoder
+This script checks the health of the RFM69GwDecoder, using only the standard library so it starts quickly
 """
-import requests
 import configparser
+import http.client
+import sys
 
 if __name__ == '__main__':
     # read the config file, so we can check the API port
     config = configparser.ConfigParser()
     config.read('/app/rfm69gw-decoder.conf')
-    apiPort = int(config['main']['apiport'])
+    apiPort = config.getint('main', 'apiport', fallback=5000)
+    # when it listens on every address, loopback is one of them
+    apiAddress = config.get('main', 'apiaddress', fallback='127.0.0.1')
+    if apiAddress in ('', '0.0.0.0', '::'):
+        apiAddress = '127.0.0.1'
 
-    # fire off an API request to /status
-    r = requests.get('http://localhost:' + str(apiPort) + '/status')
+    # fire off an API request to /health, which answers 503 when we're not healthy
+    try:
+        conn = http.client.HTTPConnection(apiAddress, apiPort, timeout=4)
+        conn.request('GET', '/health')
+        status = conn.getresponse().status
+    except OSError:
+        status = None
 
     # exit based on status code
-    if r.status_code == 200:
-        exit(0)
-    else:
-        exit(1)
\ No newline at end of file
+    sys.exit(0 if status == 200 else 1)